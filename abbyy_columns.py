@@ -0,0 +1,262 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import sys
+import os
+import array
+import json
+import mmap
+
+import numpy
+from lxml import etree
+
+import common
+
+from debug import debug, debugging, assert_d
+
+# A compact, columnar form of a book's ABBYY OCR: numpy arrays with an
+# entry per charParams, line, paragraph, block and page, built with
+# one pass over the xml and cached next to the item in a file that is
+# memory-mapped back in.  The geometry of a scanned book never
+# changes, so later runs needn't re-parse hundreds of MB of xml.
+#
+# Arrays (n = count of the things indexed):
+#   chars        uint32[n_chars]      first code point of each charParams
+#   char_box     int32[n_chars, 4]    l, t, r, b
+#   char_flags   uint8[n_chars]       WORD_START | WORD_NUMERIC | ...
+#   line_char    int64[n_lines + 1]   offset of each line's first char
+#   line_box     int32[n_lines, 4]
+#   par_line     int64[n_pars + 1]    offset of each par's first line
+#   par_flags    uint8[n_pars]        PAR_IN_TABLE
+#   block_par    int64[n_blocks + 1]  offset of each block's first par
+#   block_type   uint8[n_blocks]      index into block_types
+#   block_box    int32[n_blocks, 4]
+#   page_block   int64[n_pages + 1]   offset of each page's first block
+#   page_size    int32[n_pages, 2]    width, height
+#
+# so e.g. the chars of line j are chars[line_char[j]:line_char[j + 1]].
+
+aby_ns = '{http://www.abbyy.com/FineReader_xml/FineReader6-schema-v1.xml}'
+
+WORD_START = 1
+WORD_NUMERIC = 2
+SUSPICIOUS = 4
+WORD_FROM_DICTIONARY = 8
+
+PAR_IN_TABLE = 1
+
+block_types = ['Text', 'Table', 'Picture', 'Barcode', 'other']
+
+cache_magic = 'ABBYYCOLS1\n'
+cache_version = 1
+
+array_types = [
+    ('chars', 'uint32', 1),
+    ('char_box', 'int32', 4),
+    ('char_flags', 'uint8', 1),
+    ('line_char', 'int64', 1),
+    ('line_box', 'int32', 4),
+    ('par_line', 'int64', 1),
+    ('par_flags', 'uint8', 1),
+    ('block_par', 'int64', 1),
+    ('block_type', 'uint8', 1),
+    ('block_box', 'int32', 4),
+    ('page_block', 'int64', 1),
+    ('page_size', 'int32', 2),
+]
+
+def nons(tag):
+    return tag[tag.find('}') + 1:]
+
+def box(attrib):
+    return (int(attrib.get('l', 0)), int(attrib.get('t', 0)),
+            int(attrib.get('r', 0)), int(attrib.get('b', 0)))
+
+# parser target that appends to array.arrays as it goes
+class ColumnsTarget(object):
+    char_tag = aby_ns + 'charParams'
+    def __init__(self):
+        self.a = {}
+        for name, dtype, width in array_types:
+            self.a[name] = array.array(numpy.dtype(dtype).char)
+        for name in ('line_char', 'par_line', 'block_par', 'page_block'):
+            self.a[name].append(0)
+        self.stack = []
+        self.tables = 0
+        self.in_char = False
+        self.char_text = False
+    def start(self, tag, attrib):
+        a = self.a
+        if tag == self.char_tag:
+            flags = 0
+            if attrib.get('wordStart') == 'true':
+                flags |= WORD_START
+            if attrib.get('wordNumeric') == 'true':
+                flags |= WORD_NUMERIC
+            if attrib.get('suspicious') == 'true':
+                flags |= SUSPICIOUS
+            if attrib.get('wordFromDictionary') == 'true':
+                flags |= WORD_FROM_DICTIONARY
+            a['char_flags'].append(flags)
+            a['char_box'].extend(box(attrib))
+            a['chars'].append(0)
+            self.in_char = True
+            self.char_text = False
+            return
+        tag = nons(tag)
+        self.stack.append(tag)
+        if tag == 'line':
+            a['line_box'].extend(box(attrib))
+        elif tag == 'row':
+            self.tables += 1
+        elif tag == 'block':
+            t = attrib.get('blockType')
+            if t not in block_types:
+                t = 'other'
+            a['block_type'].append(block_types.index(t))
+            a['block_box'].extend(box(attrib))
+        elif tag == 'page':
+            a['page_size'].extend((int(attrib.get('width', 0)),
+                                   int(attrib.get('height', 0))))
+    def end(self, tag):
+        a = self.a
+        if tag == self.char_tag:
+            self.in_char = False
+            return
+        tag = self.stack.pop()
+        if tag == 'line':
+            a['line_char'].append(len(a['chars']))
+        elif tag == 'par':
+            a['par_line'].append(len(a['line_char']) - 1)
+            a['par_flags'].append(PAR_IN_TABLE if self.tables > 0 else 0)
+        elif tag == 'row':
+            self.tables -= 1
+        elif tag == 'block':
+            a['block_par'].append(len(a['par_flags']))
+        elif tag == 'page':
+            a['page_block'].append(len(a['block_type']))
+    def data(self, data):
+        if self.in_char and not self.char_text:
+            self.a['chars'][-1] = ord(data[0])
+            self.char_text = True
+    def close(self):
+        arrays = {}
+        for name, dtype, width in array_types:
+            if len(self.a[name]) > 0:
+                arr = numpy.frombuffer(self.a[name], dtype=dtype).copy()
+            else:
+                arr = numpy.zeros(0, dtype=dtype)
+            if width > 1:
+                arr = arr.reshape((-1, width))
+            arrays[name] = arr
+        return arrays
+
+# parse an ABBYY file into a dict of arrays
+def build(f, chunk_size=1024 * 1024):
+    parser = etree.XMLParser(target=ColumnsTarget(), resolve_entities=False,
+                             huge_tree=True)
+    while True:
+        data = f.read(chunk_size)
+        if not data:
+            break
+        parser.feed(data)
+    return parser.close()
+
+# Cache file layout: magic line, a json header line giving each array's
+# dtype, shape and offset, then the arrays, each 64-byte aligned.
+def save(path, arrays, stamp):
+    header = { 'version':cache_version, 'source':stamp, 'arrays':{} }
+    offset = 0
+    for name, dtype, width in array_types:
+        arr = arrays[name]
+        header['arrays'][name] = { 'dtype':dtype, 'shape':list(arr.shape),
+                                   'offset':offset }
+        offset += (arr.nbytes + 63) & ~63
+    header_str = json.dumps(header, sort_keys=True) + '\n'
+    data_start = (len(cache_magic) + len(header_str) + 63) & ~63
+    def write(f):
+        f.write(cache_magic)
+        f.write(header_str)
+        f.write('\0' * (data_start - len(cache_magic) - len(header_str)))
+        for name, dtype, width in array_types:
+            arr = arrays[name]
+            f.write(arr.tostring())
+            f.write('\0' * (((arr.nbytes + 63) & ~63) - arr.nbytes))
+    common.write_atomically(path, write, 'wb')
+
+# returns a dict of read-only arrays mapped from the cache file, or
+# None if it's missing, of another version or stale.
+def load(path, stamp=None):
+    try:
+        f = open(path, 'rb')
+    except IOError:
+        return None
+    try:
+        if f.readline() != cache_magic:
+            return None
+        header_line = f.readline()
+        header = json.loads(header_line)
+        if header.get('version') != cache_version:
+            return None
+        if stamp is not None and header.get('source') != stamp:
+            return None
+        data_start = (len(cache_magic) + len(header_line) + 63) & ~63
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    finally:
+        f.close()
+    arrays = {}
+    for name, info in header['arrays'].items():
+        shape = tuple(info['shape'])
+        count = 1
+        for n in shape:
+            count *= n
+        if count == 0:
+            arrays[name] = numpy.zeros(shape, dtype=info['dtype'])
+            continue
+        arr = numpy.frombuffer(mm, dtype=info['dtype'], count=count,
+                               offset=data_start + info['offset'])
+        arrays[name] = arr.reshape(shape)
+    return arrays
+
+class BookColumns(object):
+    def __init__(self, arrays):
+        for name, dtype, width in array_types:
+            setattr(self, name, arrays[name])
+        self.n_pages = len(self.page_block) - 1
+        # offset of each page's first par and line
+        self.page_par = self.block_par[self.page_block]
+        self.page_line = self.par_line[self.page_par]
+
+    def page_pars(self, i):
+        return xrange(self.page_par[i], self.page_par[i + 1])
+
+    def page_lines(self, i):
+        return xrange(self.page_line[i], self.page_line[i + 1])
+
+    def line_text(self, j):
+        codes = self.chars[self.line_char[j]:self.line_char[j + 1]]
+        return u''.join([unichr(c) for c in codes if c != 0])
+
+# Columns for an iarchive.Book, from the cache next to its ABBYY file
+# if that's up to date, otherwise parsed and (if the directory is
+# writable) cached.
+def get_columns(iabook, cache_path=None):
+    source_path = iabook.get_abbyy_path()
+    if cache_path is None:
+        cache_path = os.path.join(iabook.get_book_path(),
+                                  iabook.get_book_id() + '_abbyy.cols')
+    stamp = common.source_stamp(source_path)
+    arrays = load(cache_path, stamp)
+    if arrays is None:
+        f = iabook.get_abbyy()
+        arrays = build(f)
+        f.close()
+        try:
+            save(cache_path, arrays, stamp)
+        except (IOError, OSError):
+            pass
+    return BookColumns(arrays)
+
+if __name__ == '__main__':
+    sys.stderr.write('I\'m a module.  Don\'t run me directly!')
+    sys.exit(-1)
@@ -0,0 +1,286 @@
+#!/usr/bin/python
+
+import sys
+import os
+import re
+import json
+import zlib
+
+from lxml import etree
+
+import common
+
+from debug import debug, debugging, assert_d
+
+# Random access to the pages of a gzip'd ABBYY file.
+#
+# The index records the uncompressed byte range of every <page>
+# element, and the bytes before the first page (the xml declaration
+# and <document> start tag, with the namespace), so that a page can be
+# parsed on its own.  It's saved next to the item as
+# <book_id>_abbyy.idx.
+#
+# Getting at a byte range still means inflating up to it, but not
+# parsing anything on the way.  As we inflate, we keep zran-style
+# restart points - copies of the decompressor, with its 32k window,
+# every 'span' bytes of output - so later reads start from the
+# nearest one.  Python's zlib can't rebuild a decompressor from a
+# saved window, so restart points only last as long as the index
+# object; the page offsets are what's kept on disk.
+
+index_version = 2
+
+read_size = 256 * 1024
+
+class AbbyyIndex(object):
+    def __init__(self, gz_path, prelude, pages, span=2 * 1024 * 1024):
+        self.gz_path = gz_path
+        self.prelude = prelude
+        # (start, end) uncompressed offsets of each page element
+        self.pages = pages
+        self.span = span
+        # restart points: (uncompressed offset, compressed offset,
+        # decompressor), in order
+        self.points = []
+        self.f = None
+
+    def close(self):
+        if self.f is not None:
+            self.f.close()
+            self.f = None
+
+    def add_point(self, out_offset, in_offset, d):
+        if len(self.points) == 0 or out_offset >= self.points[-1][0] + self.span:
+            self.points.append((out_offset, in_offset, d.copy()))
+
+    # uncompressed bytes [start, end) of the ABBYY file
+    def read(self, start, end):
+        if self.f is None:
+            self.f = open(self.gz_path, 'rb')
+        out_offset, in_offset, d = 0, 0, None
+        for point in self.points:
+            if point[0] > start:
+                break
+            out_offset, in_offset, d = point
+        if d is None:
+            d = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        else:
+            d = d.copy()
+        self.f.seek(in_offset)
+        result = []
+        while out_offset < end:
+            data = self.f.read(read_size)
+            if not data:
+                break
+            in_offset += len(data)
+            out = d.decompress(data)
+            while d.unused_data:
+                # another gzip member follows
+                data = d.unused_data
+                d = zlib.decompressobj(16 + zlib.MAX_WBITS)
+                out += d.decompress(data)
+            if out_offset + len(out) > start:
+                result.append(out[max(0, start - out_offset):end - out_offset])
+            out_offset += len(out)
+            self.add_point(out_offset, in_offset, d)
+        return ''.join(result)
+
+    # uncompressed bytes from offset start to the end of the file, in
+    # chunks
+    def iter_from(self, start):
+        if self.f is None:
+            self.f = open(self.gz_path, 'rb')
+        out_offset, in_offset, d = 0, 0, None
+        for point in self.points:
+            if point[0] > start:
+                break
+            out_offset, in_offset, d = point
+        if d is None:
+            d = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        else:
+            d = d.copy()
+        while True:
+            # re-seek each time, as read() may share the file meanwhile
+            self.f.seek(in_offset)
+            data = self.f.read(read_size)
+            if not data:
+                break
+            in_offset += len(data)
+            out = d.decompress(data)
+            while d.unused_data:
+                data = d.unused_data
+                d = zlib.decompressobj(16 + zlib.MAX_WBITS)
+                out += d.decompress(data)
+            if out_offset + len(out) > start:
+                yield out[max(0, start - out_offset):]
+            out_offset += len(out)
+            self.add_point(out_offset, in_offset, d)
+
+    # the ABBYY file with pages before the i'th left out, in chunks
+    def iter_document_from(self, i):
+        yield self.prelude
+        if i < len(self.pages):
+            for chunk in self.iter_from(self.pages[i][0]):
+                yield chunk
+        else:
+            yield '</document>'
+
+    def page_bytes(self, i):
+        (start, end) = self.pages[i]
+        return self.read(start, end)
+
+    # bytes of pages [i, j) as a document that parses on its own
+    def pages_document(self, i, j):
+        if i >= j:
+            return self.prelude + '</document>'
+        return (self.prelude + self.read(self.pages[i][0], self.pages[j - 1][1])
+                + '</document>')
+
+    # the i'th <page> element, parsed on its own
+    def get_page(self, i):
+        root = etree.fromstring(self.pages_document(i, i + 1),
+                                etree.XMLParser(resolve_entities=False,
+                                                huge_tree=True))
+        return root[0]
+
+    def save(self, path, stamp):
+        index = { 'version':index_version,
+                  'source':stamp,
+                  'prelude':self.prelude.decode('utf-8'),
+                  'pages':self.pages }
+        common.write_atomically(path, lambda f: json.dump(index, f))
+
+page_start = '<page'
+page_end = '</page>'
+name_ends = ' \t\r\n>/'
+
+# the rest of a start tag, after its name: attributes (whose quoted
+# values may hold '>') up to the closing '>'
+tag_rest_re = re.compile(r'(?:[^>"\']|"[^"]*"|\'[^\']*\')*>')
+
+# Page tags in buf, in order, as (offset, end offset, kind), where kind
+# is 'start', 'empty' (a self-closing <page .../>, a blank leaf say)
+# or 'end', leaving out any that end within the first 'skip' bytes.
+# Also returns the offset of a start tag that isn't finished by the end
+# of buf (to look at again when there's more), or None.
+def find_page_tags(buf, skip):
+    tags = []
+    unfinished = None
+    j = buf.find(page_start)
+    while j >= 0:
+        k = j + len(page_start)
+        if k >= len(buf):
+            unfinished = j
+            break
+        if buf[k] in name_ends:
+            m = tag_rest_re.match(buf, k)
+            if m is None:
+                unfinished = j
+                break
+            if m.end() > skip:
+                kind = 'empty' if buf[m.end() - 2] == '/' else 'start'
+                tags.append((j, m.end(), kind))
+        j = buf.find(page_start, k)
+    j = buf.find(page_end)
+    while j >= 0:
+        k = j + len(page_end)
+        if unfinished is not None and j > unfinished:
+            break
+        if k > skip:
+            tags.append((j, k, 'end'))
+        j = buf.find(page_end, k)
+    tags.sort()
+    return (tags, unfinished)
+
+# One pass over the gzip'd ABBYY file, noting where each page is, and
+# keeping restart points as we go.
+def build_index(gz_path, span=2 * 1024 * 1024):
+    index = AbbyyIndex(gz_path, None, [], span)
+    f = open(gz_path, 'rb')
+    d = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    in_offset = 0
+    out_offset = 0
+    carry = ''
+    # how much of carry we've already found the tags in
+    done = 0
+    prelude = []
+    start = None
+    while True:
+        data = f.read(read_size)
+        if not data:
+            break
+        in_offset += len(data)
+        out = d.decompress(data)
+        while d.unused_data:
+            data = d.unused_data
+            d = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            out += d.decompress(data)
+        if index.prelude is None:
+            prelude.append(out)
+        # search the end of the last chunk too, for tags split between
+        # chunks; only take matches that end in this chunk.
+        buf = carry + out
+        base = out_offset - len(carry)
+        (tags, unfinished) = find_page_tags(buf, done)
+        for (j, k, kind) in tags:
+            if kind != 'end':
+                start = base + j
+                if index.prelude is None:
+                    index.prelude = ''.join(prelude)[:start]
+            if kind == 'empty':
+                index.pages.append((start, base + k))
+                start = None
+            elif kind == 'end' and start is not None:
+                index.pages.append((start, base + k))
+                start = None
+        keep = min(len(buf), len(page_end) + 1)
+        done = keep
+        if unfinished is not None:
+            # go over the unfinished start tag, and what's after it,
+            # again
+            keep = max(keep, len(buf) - unfinished)
+            done = keep - (len(buf) - unfinished)
+        carry = buf[len(buf) - keep:]
+        out_offset += len(out)
+        index.add_point(out_offset, in_offset, d)
+    f.close()
+    if index.prelude is None:
+        index.prelude = ''.join(prelude)
+    return index
+
+def load_index(gz_path, path, stamp, span=2 * 1024 * 1024):
+    try:
+        f = open(path, 'r')
+    except IOError:
+        return None
+    try:
+        index = json.load(f)
+    except ValueError:
+        return None
+    finally:
+        f.close()
+    if index.get('version') != index_version or index.get('source') != stamp:
+        return None
+    return AbbyyIndex(gz_path, index['prelude'].encode('utf-8'),
+                      [tuple(p) for p in index['pages']], span)
+
+# The index for an iarchive.Book - loaded from next to the ABBYY file
+# if it's up to date, otherwise built (and saved, if we can).
+def get_index(iabook, index_path=None):
+    gz_path = iabook.get_abbyy_path()
+    if index_path is None:
+        index_path = os.path.join(iabook.get_book_path(),
+                                  iabook.get_book_id() + '_abbyy.idx')
+    stamp = common.source_stamp(gz_path)
+    index = load_index(gz_path, index_path, stamp)
+    if index is None:
+        index = build_index(gz_path)
+        try:
+            index.save(index_path, stamp)
+        except (IOError, OSError):
+            pass
+    return index
+
+if __name__ == '__main__':
+    sys.stderr.write('I\'m a module.  Don\'t run me directly!')
+    sys.exit(-1)
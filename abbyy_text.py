@@ -0,0 +1,196 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import sys
+
+from lxml import etree
+
+from debug import debug, debugging, assert_d
+
+aby_ns = '{http://www.abbyy.com/FineReader_xml/FineReader6-schema-v1.xml}'
+
+# Pulls paragraph text out of ABBYY xml with a parser target, building
+# small records straight from the parser callbacks rather than an
+# element per charParams.
+#
+# Each page is a PageText; page.pars holds the paragraphs found in
+# the page's text blocks (table rows are skipped), in document order.
+# A paragraph is a list of lines, a line is a tuple
+#     (l, t, r, b, runs)
+# and each run - one <formatting> element - a tuple
+#     (text, joins, n_chars, numeric)
+# where text is what etree.tostring(fmt, method='text') would give,
+# joins is True if the first charParams has wordStart="false" (so the
+# run continues a word from the previous line), n_chars counts the
+# charParams, and numeric is True if they are all wordNumeric.
+
+class PageText(object):
+    __slots__ = ('width', 'height', 'pars', 'unexpected')
+    def __init__(self, width, height):
+        self.width = width
+        self.height = height
+        self.pars = []
+        # tags found directly within blocks that we don't understand
+        self.unexpected = []
+    # __slots__ objects need these to be pickled (e.g. sent back from
+    # worker processes)
+    def __getstate__(self):
+        return (self.width, self.height, self.pars, self.unexpected)
+    def __setstate__(self, state):
+        (self.width, self.height, self.pars, self.unexpected) = state
+
+def nons(tag):
+    return tag[tag.find('}') + 1:]
+
+char_tag = aby_ns + 'charParams'
+
+class PageTextTarget(object):
+    def __init__(self):
+        self.pages = []
+        self.page = None
+        self.stack = []
+        self.par = None
+        self.line = None
+        self.line_box = None
+        self.run_text = None
+        self.run_chars = 0
+        self.run_joins = False
+        self.run_numeric = True
+    def start(self, tag, attrib):
+        # charParams are by far the most common element, so deal with
+        # them first and quickly.
+        if tag == char_tag:
+            if self.run_text is not None:
+                if self.run_chars == 0:
+                    self.run_joins = attrib.get('wordStart') == 'false'
+                if self.run_numeric and attrib.get('wordNumeric') != 'true':
+                    self.run_numeric = False
+                self.run_chars += 1
+            return
+        tag = nons(tag)
+        parent = self.stack[-1] if len(self.stack) > 0 else None
+        self.stack.append(tag)
+        if parent == 'block' and tag not in ('region', 'text', 'row'):
+            self.page.unexpected.append(tag)
+        if tag == 'formatting':
+            if self.line is not None:
+                self.run_text = []
+                self.run_chars = 0
+                self.run_joins = False
+                self.run_numeric = True
+        elif tag == 'line':
+            if self.par is not None:
+                self.line = []
+                self.line_box = (int(attrib.get('l', 0)),
+                                 int(attrib.get('t', 0)),
+                                 int(attrib.get('r', 0)),
+                                 int(attrib.get('b', 0)))
+        elif tag == 'par':
+            # only paragraphs of text directly in a block - not tables
+            if len(self.stack) >= 3 and self.stack[-3] == 'block':
+                self.par = []
+        elif tag == 'page':
+            self.page = PageText(int(attrib.get('width', 0)),
+                                 int(attrib.get('height', 0)))
+    def end(self, tag):
+        if tag == char_tag:
+            return
+        tag = self.stack.pop()
+        if tag == 'formatting':
+            if self.run_text is not None:
+                self.line.append((''.join(self.run_text), self.run_joins,
+                                  self.run_chars, self.run_numeric))
+                self.run_text = None
+        elif tag == 'line':
+            if self.line is not None:
+                (l, t, r, b) = self.line_box
+                self.par.append((l, t, r, b, self.line))
+                self.line = None
+        elif tag == 'par':
+            if self.par is not None:
+                self.page.pars.append(self.par)
+                self.par = None
+        elif tag == 'page':
+            self.pages.append(self.page)
+            self.page = None
+    def data(self, data):
+        if self.run_text is not None:
+            self.run_text.append(data)
+    def close(self):
+        pass
+    def take_pages(self):
+        pages = self.pages
+        self.pages = []
+        return pages
+
+# Yields a PageText for each page of the ABBYY file f, parsing as it
+# goes.
+def iter_pages(f, chunk_size=64 * 1024):
+    return iter_pages_chunks(iter(lambda: f.read(chunk_size), ''))
+
+# The same, for an ABBYY file given as an iterable of string chunks.
+def iter_pages_chunks(chunks):
+    target = PageTextTarget()
+    parser = etree.XMLParser(target=target, resolve_entities=False,
+                             huge_tree=True)
+    for data in chunks:
+        parser.feed(data)
+        for page in target.take_pages():
+            yield page
+    parser.close()
+    for page in target.take_pages():
+        yield page
+
+rnums = ['i', 'ii', 'iii', 'iv',
+         'v', 'vi', 'vii', 'viii',
+         'ix', 'x', 'xi', 'xii',
+         'xiii', 'xiv', 'xv', 'xvi',
+         'xvii', 'xviii', 'xix', 'xx',
+         'xxi', 'xxii',
+         ]
+
+def par_is_header(par):
+    # if:
+    #   it's the first on the page
+    #   there's only one line
+    #   on that line, there's a formatting tag, s.t.
+    #   - it has < 6 charParam kids
+    #   - each is wordNumeric
+    # then:
+    #   Skip it!
+    if len(par) != 1:
+        return False
+    (l, t, r, b, runs) = par[0]
+    for (text, joins, n_chars, numeric) in runs:
+        if n_chars > 6:
+            continue
+        if numeric:
+            return True
+        if text in rnums:
+            return True
+    return False
+
+# The text of a paragraph, with lines joined by spaces, and words
+# hyphenated across lines put back together.
+def par_text(par):
+    lines = []
+    prev_line = ''
+    for (l, t, r, b, runs) in par:
+        for (text, joins, n_chars, numeric) in runs:
+            if len(text) > 0:
+                if prev_line[-1:] == '-':
+                    if joins:
+                        # ? and wordFromDictionary = true ?
+                        lines.append(prev_line[:-1])
+                    else:
+                        lines.append(prev_line)
+                else:
+                    lines.append(prev_line)
+                    lines.append(' ')
+                prev_line = text
+    lines.append(prev_line)
+    return ''.join(lines)
+
+if __name__ == '__main__':
+    sys.stderr.write('I\'m a module.  Don\'t run me directly!')
+    sys.exit(-1)
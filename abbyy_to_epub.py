@@ -4,33 +4,96 @@
 import sys
 import getopt
 import os
+import time
+import json
+import shutil
+import stat
+import traceback
 
 import epub
 import iarchive
 import process_abbyy
 import common
+import stats
+import checkpoint
+import build_cache
 
 from debug import debug, debugging, assert_d
 
 def usage():
     sys.stderr.write("\n")
     sys.stderr.write("Usage: abbyy_to_epub.py book_id path_to_book_files [out.epub]\n")
-    sys.stderr.write("  Output defaults to book_id.epub.\n")
+    sys.stderr.write("       abbyy_to_epub.py -b booklist [-j jobs] [--outdir dir]\n")
+    sys.stderr.write("  Output defaults to book_id.epub; '-' writes to stdout.\n")
     sys.stderr.write("\n")
     sys.stderr.write("  -d calls epubcheck-1.0.3.jar to check output.\n")
     sys.stderr.write("  (epubcheck jar is assumed to be in the script directory)\n")
+    sys.stderr.write("\n")
+    sys.stderr.write("  -b, --batch=FILE  convert every book listed in FILE ('-' for\n")
+    sys.stderr.write("                    stdin), one per line, as\n")
+    sys.stderr.write("                    'book_id [path_to_book_files [out.epub]]'\n")
+    sys.stderr.write("                    or just a path to the book files.\n")
+    sys.stderr.write("  -j, --jobs=N      worker processes for batch mode (default 1)\n")
+    sys.stderr.write("  --outdir=DIR      batch mode output directory (default .)\n")
+    sys.stderr.write("  --summary=FILE    write batch summary to FILE (default stderr)\n")
+    sys.stderr.write("\n")
+    sys.stderr.write("  --decoder=NAME    page image decoder: 'netpbm' (external\n")
+    sys.stderr.write("                    kdu_expand/netpbm tools, the default) or\n")
+    sys.stderr.write("                    'pillow' (in-process, needs PIL)\n")
+    sys.stderr.write("  --image-threads=N threads decoding page images ahead of the\n")
+    sys.stderr.write("                    text (default 4, 0 to decode in line)\n")
+    sys.stderr.write("  --deflate-threads=N threads compressing epub members\n")
+    sys.stderr.write("                    (default 2, 0 to compress in line)\n")
+    sys.stderr.write("  --compression=P   'default', 'fast' or 'smallest'\n")
+    sys.stderr.write("  --text-workers=N  processes extracting text from page ranges\n")
+    sys.stderr.write("                    (default 1, i.e. serially)\n")
+    sys.stderr.write("  --chunk-size=KB   aim for text chunks of about this much xhtml\n")
+    sys.stderr.write("                    (default 64)\n")
+    sys.stderr.write("  --running-heads   find running heads and feet (page numbers,\n")
+    sys.stderr.write("                    book and chapter titles) over the whole\n")
+    sys.stderr.write("                    book, and leave them out; otherwise only\n")
+    sys.stderr.write("                    page numbers heading a page are left out\n")
+    sys.stderr.write("  --checkpoint-dir=DIR save progress in DIR/book_id as the book\n")
+    sys.stderr.write("                    is made, and resume from there if a\n")
+    sys.stderr.write("                    conversion of the same book failed part way\n")
+    sys.stderr.write("  --cache-dir=DIR   keep finished epubs in DIR, keyed on the book's\n")
+    sys.stderr.write("                    inputs and settings, and reuse them when\n")
+    sys.stderr.write("                    nothing has changed\n")
+    sys.stderr.write("  --cache-size=MB   size limit for --cache-dir (default 10240)\n")
+    sys.stderr.write("  --image-cache=DIR keep scaled page images in DIR for reuse\n")
+    sys.stderr.write("  --image-cache-size=MB size limit for --image-cache (default 1024)\n")
+    sys.stderr.write("\n")
+    sys.stderr.write("  --stats           report time and calls per conversion stage,\n")
+    sys.stderr.write("                    peak RSS and bytes per member type on stderr\n")
+    sys.stderr.write("  --stats-json=FILE write the same as json to FILE ('-' for\n")
+    sys.stderr.write("                    stderr); a list, one per book, in batch mode\n")
 
 def main(argv):
     epub_out = None
     import getopt
     try:
         opts, args = getopt.getopt(argv,
-                                   "dho:",
-                                   ["debug", "help", "outfile="])
+                                   "dho:b:j:",
+                                   ["debug", "help", "outfile=",
+                                    "batch=", "jobs=", "outdir=", "summary=",
+                                    "decoder=", "image-threads=",
+                                    "deflate-threads=", "compression=",
+                                    "text-workers=", "stats", "stats-json=",
+                                    "checkpoint-dir=", "cache-dir=",
+                                    "cache-size=", "image-cache=",
+                                    "image-cache-size=", "chunk-size=",
+                                    "running-heads"])
     except getopt.GetoptError:
         usage()
         sys.exit(-1)
     debug_output = False
+    batch_file = None
+    jobs = 1
+    outdir = '.'
+    summary_file = None
+    show_stats = False
+    stats_json = None
+    options = {}
     for opt, arg in opts:
         if opt in ('-h', '--help'):
             usage()
@@ -39,6 +102,83 @@ def main(argv):
             debug_output = True
         elif opt in ('-o', '--outfile'):
             epub_out = arg
+        elif opt in ('-b', '--batch'):
+            batch_file = arg
+        elif opt in ('-j', '--jobs'):
+            jobs = int(arg)
+        elif opt == '--outdir':
+            outdir = arg
+        elif opt == '--summary':
+            summary_file = arg
+        elif opt == '--decoder':
+            options['image_decoder'] = arg
+        elif opt == '--image-threads':
+            options['image_threads'] = int(arg)
+        elif opt == '--deflate-threads':
+            options['deflate_threads'] = int(arg)
+        elif opt == '--compression':
+            if arg not in epub.compression_presets:
+                print 'unknown compression preset ' + arg
+                usage()
+                sys.exit(-1)
+            options['compression'] = arg
+        elif opt == '--text-workers':
+            options['text_workers'] = int(arg)
+        elif opt == '--cache-dir':
+            options['cache_dir'] = arg
+        elif opt == '--cache-size':
+            options['cache_bytes'] = int(arg) * 1024 * 1024
+        elif opt == '--chunk-size':
+            options['chunk_bytes'] = int(arg) * 1024
+        elif opt == '--running-heads':
+            options['running_heads'] = True
+        elif opt == '--image-cache':
+            options['image_cache_dir'] = arg
+        elif opt == '--image-cache-size':
+            options['image_cache_bytes'] = int(arg) * 1024 * 1024
+        elif opt == '--checkpoint-dir':
+            options['checkpoint_dir'] = arg
+        elif opt == '--stats':
+            show_stats = True
+            options['stats'] = True
+        elif opt == '--stats-json':
+            stats_json = arg
+            options['stats'] = True
+
+    if batch_file is not None:
+        if len(args) != 0 or epub_out is not None:
+            print 'book arguments and -o are not used in batch mode'
+            usage()
+            sys.exit(-1)
+        if batch_file == '-':
+            books = read_book_list(sys.stdin, outdir, options)
+        else:
+            f = open(batch_file, 'r')
+            books = read_book_list(f, outdir, options)
+            f.close()
+        results = convert_batch(books, jobs)
+        if summary_file is None:
+            write_summary(results, sys.stderr)
+        else:
+            f = open(summary_file, 'w')
+            write_summary(results, f)
+            f.close()
+        if show_stats:
+            for r in results:
+                if r.get('stats') is not None:
+                    sys.stderr.write('\n' + r['book_id'] + ':\n')
+                    stats.write_report(r['stats'], sys.stderr)
+        if stats_json is not None:
+            write_stats_json([{ 'book_id':r['book_id'],
+                                'epub_out':r['epub_out'],
+                                'status':r['status'],
+                                'seconds':r['seconds'],
+                                'stats':r.get('stats') } for r in results],
+                             stats_json)
+        if len([r for r in results if r['status'] != 'ok']) > 0:
+            sys.exit(1)
+        return
+
     if len(args) == 0:
         book_id = common.get_book_id()
         if book_id is None:
@@ -72,22 +212,320 @@ def main(argv):
     if epub_out is None:
         epub_out = book_id + '.epub'
 
-# probably busted due to getopt
-#     if epub_out == '-':
-#         epub_out = sys.stdout
-
-    iabook = iarchive.Book(book_id, book_path)
-    ebook = epub.Book(epub_out, include_page_map=False)
-
-    process_abbyy.process_book(iabook, ebook)
+    report = convert(book_id, book_path, epub_out, options)
+    if show_stats:
+        stats.write_report(report, sys.stderr)
+    if stats_json is not None:
+        write_stats_json({ 'book_id':book_id,
+                           'epub_out':epub_out,
+                           'stats':report }, stats_json)
 
-    meta_info_items = process_abbyy.get_meta_items(iabook)
-    ebook.finish(meta_info_items)
-
-    if debug_output:
+    if debug_output and epub_out != '-':
         epubcheck = os.path.join(sys.path[0], 'epubcheck-1.0.3.jar')
         output = os.popen('java -jar ' + epubcheck + ' ' + epub_out)
         print output.read()
 
+# options is a dict of converter settings, e.g. { 'image_decoder':'pillow' }
+# Returns a stats.report() if options['stats'] is set, otherwise None.
+def convert(book_id, book_path, epub_out, options=None):
+    if options is None:
+        options = {}
+    if epub_out == '-':
+        epub_out = sys.stdout
+    if not options.get('stats', False):
+        do_convert(book_id, book_path, epub_out, options)
+        return None
+    stats.reset()
+    try:
+        do_convert(book_id, book_path, epub_out, options)
+        return stats.report()
+    finally:
+        stats.stop()
+
+def do_convert(book_id, book_path, epub_out, options):
+    image_cache = None
+    if options.get('image_cache_dir') is not None:
+        image_cache = iarchive.get_image_cache(
+            options['image_cache_dir'],
+            options.get('image_cache_bytes',
+                        iarchive.default_image_cache_bytes))
+    with iarchive.Book(book_id, book_path,
+                       image_decoder=options.get('image_decoder',
+                                                 'netpbm'),
+                       image_cache=image_cache) as iabook:
+        cache = None
+        if options.get('cache_dir') is not None:
+            cache = build_cache.get_cache(options['cache_dir'],
+                                          options.get('cache_bytes',
+                                                      build_cache.default_max_bytes))
+            with stats.timed('build_cache'):
+                key = build_cache.book_key(iabook, options)
+                if copy_cached(cache, key, epub_out):
+                    return
+        ckpt = None
+        if options.get('checkpoint_dir') is not None:
+            ckpt = checkpoint.Checkpoint(os.path.join(options['checkpoint_dir'],
+                                                      book_id),
+                                         checkpoint.book_key(iabook,
+                                                             options))
+        text_workers = options.get('text_workers', 1)
+        # before epub.Book starts its threads
+        text_pool = process_abbyy.start_text_pool(text_workers)
+        try:
+            ebook = epub.Book(epub_out, include_page_map=False,
+                              deflate_threads=options.get('deflate_threads',
+                                                          2),
+                              compression=options.get('compression',
+                                                      'default'),
+                              journal=ckpt)
+            try:
+                skip_pars = None
+                if options.get('running_heads', False):
+                    # needs numpy
+                    import running_heads
+                    with stats.timed('heads'):
+                        skip_pars = running_heads.find_running_heads(
+                            iabook.get_abbyy_columns())
+                process_abbyy.process_book(
+                    iabook, ebook,
+                    image_threads=options.get('image_threads', 4),
+                    text_pool=text_pool,
+                    text_workers=text_workers,
+                    checkpoint=ckpt,
+                    chunk_bytes=options.get('chunk_bytes'),
+                    skip_pars=skip_pars)
+
+                meta_info_items = process_abbyy.get_meta_items(iabook)
+                ebook.finish(meta_info_items)
+            except:
+                ebook.abort()
+                if ckpt is not None:
+                    ckpt.close()
+                raise
+        finally:
+            if text_pool is not None:
+                text_pool.terminate()
+                text_pool.join()
+        if ckpt is not None:
+            ckpt.remove()
+        if cache is not None and isinstance(epub_out, basestring):
+            cache.put_file(key, epub_out)
+
+# epub_out is a path or a file object; returns False on a cache miss
+def copy_cached(cache, key, epub_out):
+    if isinstance(epub_out, basestring):
+        return cache.copy_out(key, epub_out)
+    path = cache.lookup(key)
+    if path is None:
+        return False
+    try:
+        f = open(path, 'rb')
+    except IOError:
+        return False
+    shutil.copyfileobj(f, epub_out)
+    f.close()
+    return True
+
+def read_book_list(f, outdir='.', options=None):
+    # each line is 'book_id [path_to_book_files [out.epub]]', or a path
+    # to a directory of book files named after the book id.
+    books = []
+    for line in f:
+        fields = line.split()
+        if len(fields) == 0 or fields[0].startswith('#'):
+            continue
+        if len(fields) == 1 and os.path.isdir(fields[0]):
+            book_path = fields[0]
+            book_id = os.path.basename(os.path.normpath(book_path))
+        else:
+            book_id = fields[0]
+            book_path = fields[1] if len(fields) > 1 else book_id
+        if len(fields) > 2:
+            epub_out = fields[2]
+        else:
+            epub_out = os.path.join(outdir, book_id + '.epub')
+        books.append({ 'book_id':book_id,
+                       'book_path':book_path,
+                       'epub_out':epub_out,
+                       'options':options })
+    return books
+
+def convert_batch_item(book):
+    # Runs in a worker process - never lets an exception (or a
+    # sys.exit from deep in the converter) escape, so one bad book
+    # can't take down the batch.
+    result = dict(book)
+    start = time.time()
+    stamp = file_stamp(book['epub_out'])
+    try:
+        result['stats'] = convert(book['book_id'], book['book_path'],
+                                  book['epub_out'], book['options'])
+        result['status'] = 'ok'
+    except KeyboardInterrupt:
+        raise
+    except BaseException, e:
+        result['status'] = 'failed'
+        result['error'] = traceback.format_exc()
+        remove_new_output(book['epub_out'], stamp)
+    result['seconds'] = time.time() - start
+    return result
+
+# enough to tell whether the file at path has been written or replaced
+# since; None if there's no file
+def file_stamp(path):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (st.st_ino, st.st_size, st.st_mtime)
+
+# remove what a failed conversion left at path, but not a file that
+# was there before it and that it didn't get as far as touching
+def remove_new_output(path, stamp):
+    if file_stamp(path) not in (None, stamp):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+# Runs convert_batch_item(book) in a process of its own, so that a
+# book that kills its worker outright (a segfault, the OOM killer)
+# is only a failure, rather than a result that never comes.
+# close_sockets - close every socket the worker inherits before it
+# starts, e.g. a server's listening socket and its connections, which
+# would otherwise stay open for as long as the book takes.
+class BatchProcess(object):
+    def __init__(self, book, close_sockets=False):
+        import multiprocessing
+        self.book = book
+        self.start = time.time()
+        self.stamp = file_stamp(book['epub_out'])
+        (self.conn, child_conn) = multiprocessing.Pipe(False)
+        self.process = multiprocessing.Process(target=run_batch_process,
+                                               args=(book, child_conn,
+                                                     close_sockets))
+        self.process.start()
+        child_conn.close()
+
+    # the book's result, or None if it isn't finished
+    def poll(self):
+        if not self.conn.poll():
+            if self.process.is_alive():
+                return None
+            # it may have sent the result just before exiting
+            if not self.conn.poll():
+                return self.lost()
+        try:
+            result = self.conn.recv()
+        except (EOFError, IOError):
+            return self.lost()
+        self.process.join()
+        self.conn.close()
+        return result
+
+    # a result for a worker that died without giving one
+    def lost(self):
+        self.process.join()
+        self.conn.close()
+        code = self.process.exitcode
+        if code < 0:
+            why = 'killed by signal %d' % -code
+        else:
+            why = 'exited with status %d' % code
+        remove_new_output(self.book['epub_out'], self.stamp)
+        result = dict(self.book)
+        result['status'] = 'failed'
+        result['error'] = 'worker process ' + why + ' part way through\n'
+        result['seconds'] = time.time() - self.start
+        return result
+
+    def terminate(self):
+        self.process.terminate()
+        self.process.join()
+        self.conn.close()
+        remove_new_output(self.book['epub_out'], self.stamp)
+
+def run_batch_process(book, conn, close_sockets=False):
+    if close_sockets:
+        close_inherited_sockets()
+    conn.send(convert_batch_item(book))
+    conn.close()
+
+def close_inherited_sockets():
+    if os.path.isdir('/proc/self/fd'):
+        fds = [int(name) for name in os.listdir('/proc/self/fd')]
+    else:
+        fds = range(3, os.sysconf('SC_OPEN_MAX'))
+    for fd in fds:
+        try:
+            if stat.S_ISSOCK(os.fstat(fd).st_mode):
+                os.close(fd)
+        except OSError:
+            pass
+
+# how often, in seconds, convert_batch looks in on its workers
+batch_poll_interval = 0.1
+
+def convert_batch(books, jobs=1):
+    results = []
+    if jobs <= 1 or len(books) <= 1:
+        for book in books:
+            results.append(convert_batch_item(book))
+            report_result(results[-1])
+        return results
+    # a fresh process per book, so a leaky one doesn't bloat the rest
+    # of the run
+    results = [None] * len(books)
+    running = {}
+    next_book = 0
+    try:
+        while next_book < len(books) or len(running) > 0:
+            while next_book < len(books) and len(running) < jobs:
+                running[next_book] = BatchProcess(books[next_book])
+                next_book += 1
+            finished = False
+            for j in sorted(running.keys()):
+                result = running[j].poll()
+                if result is not None:
+                    del running[j]
+                    results[j] = result
+                    report_result(result)
+                    finished = True
+            if not finished:
+                time.sleep(batch_poll_interval)
+    except:
+        for bp in running.values():
+            bp.terminate()
+        raise
+    return results
+
+def report_result(result):
+    sys.stderr.write('%s %s (%.1fs)\n' % (result['status'],
+                                          result['book_id'],
+                                          result['seconds']))
+
+def write_summary(results, out):
+    failed = [r for r in results if r['status'] != 'ok']
+    total_time = sum([r['seconds'] for r in results])
+    out.write('converted %d of %d books, %d failed (%.1fs total)\n'
+              % (len(results) - len(failed), len(results), len(failed),
+                 total_time))
+    for r in results:
+        out.write('%s\t%s\t%s\t%.1f\n' % (r['status'], r['book_id'],
+                                          r['epub_out'], r['seconds']))
+    for r in failed:
+        out.write('\n' + r['book_id'] + ' failed:\n')
+        out.write(r['error'])
+
+def write_stats_json(obj, path):
+    if path == '-':
+        f = sys.stderr
+    else:
+        f = open(path, 'w')
+    json.dump(obj, f, indent=1, sort_keys=True)
+    f.write('\n')
+    if f is not sys.stderr:
+        f.close()
+
 if __name__ == '__main__':
     main(sys.argv[1:])
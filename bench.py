@@ -0,0 +1,253 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import sys
+import getopt
+import os
+import time
+import json
+import shutil
+import tempfile
+import resource
+import multiprocessing
+
+import epub
+import iarchive
+import process_abbyy
+import abbyy_text
+import synth_book
+
+from debug import debug, debugging, assert_d
+
+# Times process_abbyy.process_book + epub.Book.finish over synthetic
+# books (see synth_book.py) of various sizes.  Each run is in a fresh
+# process, so that its peak RSS is its own.
+#
+# The caches a conversion leaves next to the item (derived_caches) are
+# removed before each run, so every run is timed from cold, as a book's
+# first conversion is; with --warm they're made once beforehand and
+# kept, as for a book that's converted again.
+
+derived_caches = ('_scandata.cache', '_abbyy.idx', '_abbyy.cols')
+
+def usage():
+    sys.stderr.write("\n")
+    sys.stderr.write("Usage: bench.py [options]\n")
+    sys.stderr.write("  Converts synthetic books, reporting pages/sec, chars/sec\n")
+    sys.stderr.write("  and peak RSS for each.\n")
+    sys.stderr.write("\n")
+    sys.stderr.write("  -p, --pages=N,...   leaves per book (default 100,400)\n")
+    sys.stderr.write("  -w, --words=N,...   words per text page (default 300)\n")
+    sys.stderr.write("  -r, --repeat=N      runs per book; the fastest is reported\n")
+    sys.stderr.write("                      (default 3)\n")
+    sys.stderr.write("  --workdir=DIR       keep (and reuse) the books in DIR, rather\n")
+    sys.stderr.write("                      than a temporary directory\n")
+    sys.stderr.write("  --jp2               books with _jp2.zip page images\n")
+    sys.stderr.write("  --warm              make the scandata and ABBYY index caches\n")
+    sys.stderr.write("                      before timing, and keep them, rather\n")
+    sys.stderr.write("                      than removing them before each run\n")
+    sys.stderr.write("  --json=FILE         also write results to FILE as json\n")
+    sys.stderr.write("\n")
+    sys.stderr.write("  --decoder, --image-threads, --deflate-threads, --compression,\n")
+    sys.stderr.write("  --text-workers and --chunk-size are as for abbyy_to_epub.py\n")
+
+def main(argv):
+    try:
+        opts, args = getopt.getopt(argv, "hp:w:r:",
+                                   ["help", "pages=", "words=", "repeat=",
+                                    "workdir=", "jp2", "warm", "json=",
+                                    "decoder=", "image-threads=",
+                                    "deflate-threads=", "compression=",
+                                    "text-workers=", "chunk-size="])
+    except getopt.GetoptError:
+        usage()
+        sys.exit(-1)
+    if len(args) != 0:
+        usage()
+        sys.exit(-1)
+    page_counts = [100, 400]
+    word_counts = [300]
+    repeat = 3
+    workdir = None
+    image_type = 'tif'
+    warm = False
+    json_file = None
+    options = {}
+    for opt, arg in opts:
+        if opt in ('-h', '--help'):
+            usage()
+            sys.exit()
+        elif opt in ('-p', '--pages'):
+            page_counts = [int(n) for n in arg.split(',')]
+        elif opt in ('-w', '--words'):
+            word_counts = [int(n) for n in arg.split(',')]
+        elif opt in ('-r', '--repeat'):
+            repeat = int(arg)
+        elif opt == '--workdir':
+            workdir = arg
+        elif opt == '--jp2':
+            image_type = 'jp2'
+        elif opt == '--warm':
+            warm = True
+        elif opt == '--json':
+            json_file = arg
+        elif opt == '--decoder':
+            options['image_decoder'] = arg
+        elif opt == '--image-threads':
+            options['image_threads'] = int(arg)
+        elif opt == '--deflate-threads':
+            options['deflate_threads'] = int(arg)
+        elif opt == '--compression':
+            options['compression'] = arg
+        elif opt == '--text-workers':
+            options['text_workers'] = int(arg)
+        elif opt == '--chunk-size':
+            options['chunk_bytes'] = int(arg) * 1024
+
+    keep = workdir is not None
+    if workdir is None:
+        workdir = tempfile.mkdtemp(prefix='epub_bench')
+    results = []
+    try:
+        print 'caches: ' + ('warm' if warm else 'cold')
+        print ('%6s %6s %8s %9s %11s %10s'
+               % ('pages', 'words', 'secs', 'pages/s', 'chars/s', 'rss MB'))
+        for pages in page_counts:
+            for words in word_counts:
+                book_id = 'bench_%d_%d_%s' % (pages, words, image_type)
+                book_path = get_book(workdir, book_id, pages, words,
+                                     image_type)
+                result = bench_book(book_id, book_path, options, repeat,
+                                    warm)
+                result['leaves'] = pages
+                result['words_per_page'] = words
+                results.append(result)
+                print ('%6d %6d %8.2f %9.1f %11.0f %10.1f'
+                       % (pages, words, result['secs'],
+                          result['pages_per_sec'], result['chars_per_sec'],
+                          result['peak_rss_kb'] / 1024.0))
+    finally:
+        if not keep:
+            shutil.rmtree(workdir, True)
+    if json_file is not None:
+        f = open(json_file, 'w')
+        json.dump({ 'options':options, 'image_type':image_type,
+                    'caches':'warm' if warm else 'cold',
+                    'results':results }, f, indent=1, sort_keys=True)
+        f.write('\n')
+        f.close()
+
+# generate the book, unless it's already there from an earlier run
+def get_book(workdir, book_id, pages, words, image_type):
+    book_path = os.path.join(workdir, book_id)
+    if os.path.exists(os.path.join(book_path, book_id + '_meta.xml')):
+        return book_path
+    return synth_book.make_book(book_id, workdir, pages, words,
+                                image_type=image_type)
+
+# OCR pages and characters in the book, for the rates
+def count_text(iabook):
+    pages = 0
+    chars = 0
+    f = iabook.get_abbyy()
+    for page in abbyy_text.iter_pages(f):
+        pages += 1
+        for par in page.pars:
+            for (l, t, r, b, runs) in par:
+                for (text, joins, n_chars, numeric) in runs:
+                    chars += n_chars
+    f.close()
+    return (pages, chars)
+
+def bench_book(book_id, book_path, options, repeat, warm=False):
+    iabook = iarchive.Book(book_id, book_path,
+                           image_decoder=options.get('image_decoder',
+                                                     'netpbm'))
+    (pages, chars) = count_text(iabook)
+    if warm:
+        iabook.get_scandata()
+        iabook.get_abbyy_index()
+    iabook.close()
+    best = None
+    peak_rss = 0
+    for i in range(repeat):
+        if not warm:
+            clear_caches(book_id, book_path)
+        (secs, rss) = run_in_child(book_id, book_path, options)
+        if best is None or secs < best:
+            best = secs
+        peak_rss = max(peak_rss, rss)
+    return { 'book_id':book_id,
+             'pages':pages,
+             'chars':chars,
+             'secs':best,
+             'pages_per_sec':pages / best if best > 0 else 0.0,
+             'chars_per_sec':chars / best if best > 0 else 0.0,
+             'peak_rss_kb':peak_rss }
+
+def clear_caches(book_id, book_path):
+    for suffix in derived_caches:
+        path = os.path.join(book_path, book_id + suffix)
+        if os.path.exists(path):
+            os.remove(path)
+
+def run_in_child(book_id, book_path, options):
+    (recv_conn, send_conn) = multiprocessing.Pipe(False)
+    p = multiprocessing.Process(target=child_run,
+                                args=(send_conn, book_id, book_path, options))
+    p.start()
+    send_conn.close()
+    try:
+        result = recv_conn.recv()
+    except EOFError:
+        result = None
+    p.join()
+    if result is None or isinstance(result, basestring):
+        raise Exception('benchmark run of ' + book_id + ' failed: '
+                        + str(result))
+    return result
+
+def child_run(conn, book_id, book_path, options):
+    try:
+        conn.send(run_once(book_id, book_path, options))
+    except Exception, e:
+        conn.send(repr(e))
+    conn.close()
+
+# one conversion, to /dev/null; returns (wall seconds, peak RSS in KB)
+def run_once(book_id, book_path, options):
+    out = open(os.devnull, 'wb')
+    start = time.time()
+    with iarchive.Book(book_id, book_path,
+                       image_decoder=options.get('image_decoder',
+                                                 'netpbm')) as iabook:
+        text_workers = options.get('text_workers', 1)
+        # before epub.Book starts its threads
+        text_pool = process_abbyy.start_text_pool(text_workers)
+        try:
+            ebook = epub.Book(out, include_page_map=False,
+                              deflate_threads=options.get('deflate_threads',
+                                                          2),
+                              compression=options.get('compression',
+                                                      'default'))
+            process_abbyy.process_book(iabook, ebook,
+                                       image_threads=options.get(
+                                           'image_threads', 4),
+                                       text_pool=text_pool,
+                                       text_workers=text_workers,
+                                       chunk_bytes=options.get('chunk_bytes'))
+            ebook.finish(process_abbyy.get_meta_items(iabook))
+        finally:
+            if text_pool is not None:
+                text_pool.terminate()
+                text_pool.join()
+    secs = time.time() - start
+    out.close()
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        # bytes, not KB
+        rss /= 1024
+    return (secs, rss)
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,75 @@
+#!/usr/bin/python
+
+import sys
+import os
+import hashlib
+
+import disk_cache
+
+from debug import debug, debugging, assert_d
+
+# A cache of finished epubs, keyed on everything that goes into one:
+# the item's abbyy, scandata and metadata files, the page images
+# (by their names, sizes and crcs in the image zip's directory, which
+# is much quicker than reading them), the converter settings that
+# change the output, and the converter's own source.  Touching
+# unrelated files in an item, or re-uploading the same ones, doesn't
+# change the key.
+
+default_max_bytes = 10 * 1024 * 1024 * 1024
+
+# settings that make a difference to the epub (threads and workers
+# don't), with their defaults
+output_options = { 'image_decoder':'netpbm',
+                   'compression':'default',
+                   'chunk_bytes':None,
+                   'running_heads':False }
+
+# modules whose code decides what's in the epub
+source_modules = ('abbyy_to_epub', 'process_abbyy', 'abbyy_text', 'epub',
+                  'zipstream', 'iarchive', 'scandata', 'image_decode',
+                  'abbyy_columns', 'running_heads', 'common')
+
+def file_digest(path, h=None):
+    if h is None:
+        h = hashlib.sha1()
+    f = open(path, 'rb')
+    while True:
+        data = f.read(1024 * 1024)
+        if not data:
+            break
+        h.update(data)
+    f.close()
+    return h.hexdigest()
+
+# (found next to this one, rather than imported - some need numpy,
+# which only --running-heads does)
+def source_digest():
+    h = hashlib.sha1()
+    source_dir = os.path.dirname(os.path.abspath(__file__))
+    for name in source_modules:
+        path = os.path.join(source_dir, name + '.py')
+        h.update(name + ':' + file_digest(path) + '\n')
+    return h.hexdigest()
+
+def book_key(iabook, options):
+    parts = ['build 1',
+             source_digest(),
+             file_digest(iabook.get_abbyy_path()),
+             file_digest(iabook.get_scandata_path()),
+             file_digest(iabook.get_metadata_path())]
+    for name in sorted(output_options.keys()):
+        parts.append(name + '=' + str(options.get(name, output_options[name])))
+    parts.append(iabook.images_type)
+    for leaf in sorted(iabook.image_members.keys()):
+        info = iabook.image_members[leaf]
+        parts.append('%d %s %d %08x' % (leaf, info.filename, info.file_size,
+                                        info.CRC))
+    return disk_cache.hex_key(*parts)
+
+def get_cache(cache_dir, max_bytes=default_max_bytes):
+    return disk_cache.DiskCache(cache_dir, max_bytes, suffix='.epub')
+
+if __name__ == '__main__':
+    sys.stderr.write('I\'m a module.  Don\'t run me directly!')
+    sys.exit(-1)
@@ -0,0 +1,170 @@
+#!/usr/bin/python
+
+import sys
+import os
+import json
+import shutil
+import hashlib
+
+import build_cache
+import common
+
+from debug import debug, debugging, assert_d
+
+# Checkpoints for a book conversion, so that one that dies part way
+# through (a bad page, an image tool falling over, a killed batch
+# worker) can be picked up again where it left off.
+#
+# The work directory holds
+#   members/NNNNNN    the content of each member added with add_content
+#   members.log       a json line per member: its manifest info
+#   state.json        the last checkpoint: the epub.Book state, how
+#                     many members it covers, and the converter's own
+#                     state, including the index of the next ABBYY
+#                     page to process
+#
+# Members are saved as they're added, but only count once a later
+# checkpoint covers them; those added after the last checkpoint are
+# thrown away on resuming, and made again.
+
+checkpoint_version = 1
+
+# the page images, as the image archive's list of members: their
+# names, sizes and crcs (as build_cache.book_key has them)
+def images_digest(iabook):
+    h = hashlib.sha1(iabook.images_type)
+    for leaf in sorted(iabook.image_members.keys()):
+        info = iabook.image_members[leaf]
+        h.update('\n%d %s %d %08x' % (leaf, info.filename, info.file_size,
+                                       info.CRC))
+    return h.hexdigest()
+
+# what a checkpoint is only good for - the same book sources and page
+# images, the same converter (its source, as build_cache has it), and
+# the same settings the epub depends on, as build_cache.output_options
+# (options are as for abbyy_to_epub.convert)
+def book_key(iabook, options=None):
+    if options is None:
+        options = {}
+    decoder = iabook.image_decoder
+    return { 'version':checkpoint_version,
+             'book_id':iabook.get_book_id(),
+             'abbyy':common.source_stamp(iabook.get_abbyy_path()),
+             'scandata':common.source_stamp(iabook.get_scandata_path()),
+             'images':images_digest(iabook),
+             'image_decoder':getattr(decoder, 'name', None),
+             'compression':options.get('compression', 'default'),
+             'chunk_bytes':options.get('chunk_bytes'),
+             'running_heads':options.get('running_heads', False),
+             'source':build_cache.source_digest() }
+
+class Checkpoint(object):
+    def __init__(self, work_dir, key):
+        self.work_dir = work_dir
+        self.key = key
+        self.members_dir = os.path.join(work_dir, 'members')
+        self.log_path = os.path.join(work_dir, 'members.log')
+        self.state_path = os.path.join(work_dir, 'state.json')
+        self.log = None
+        # members saved, and members covered by the last checkpoint
+        self.n_members = 0
+        self.n_committed = 0
+
+    def load_state(self):
+        try:
+            f = open(self.state_path, 'r')
+        except IOError:
+            return None
+        try:
+            state = json.load(f)
+        except ValueError:
+            return None
+        finally:
+            f.close()
+        if state.get('key') != self.key:
+            return None
+        return state
+
+    # Start afresh, or if there's a good checkpoint, put its members
+    # and state into ebook.  Returns the converter state saved with
+    # the checkpoint, or None if starting afresh.
+    def restore(self, ebook):
+        state = self.load_state()
+        if state is None:
+            if os.path.exists(self.work_dir):
+                shutil.rmtree(self.work_dir)
+            os.makedirs(self.members_dir)
+            self.log = open(self.log_path, 'w')
+            return None
+        n = state['n_members']
+        f = open(self.log_path, 'r')
+        infos = [json.loads(f.readline()) for j in range(n)]
+        f.close()
+        journal = ebook.journal
+        ebook.journal = None
+        for j, info in enumerate(infos):
+            ebook.add_content(info, self.read_member(j))
+        ebook.journal = journal
+        ebook.set_state(state['ebook'])
+        # forget anything saved after the checkpoint
+        self.log = open(self.log_path, 'w')
+        for info in infos:
+            self.log.write(json.dumps(info) + '\n')
+        self.log.flush()
+        self.n_members = self.n_committed = n
+        return state['process']
+
+    def member_path(self, j):
+        return os.path.join(self.members_dir, str(j).zfill(6))
+
+    def read_member(self, j):
+        f = open(self.member_path(j), 'rb')
+        content = f.read()
+        f.close()
+        return content
+
+    # epub.Book journal hooks
+    def save_member(self, info, content):
+        f = self.open_member(info)
+        f.write(content)
+        f.close()
+        self.commit_member(info)
+
+    # a file for the next member's content; commit_member once it's
+    # written and closed
+    def open_member(self, info):
+        return open(self.member_path(self.n_members), 'wb')
+
+    def commit_member(self, info):
+        self.log.write(json.dumps(info) + '\n')
+        self.log.flush()
+        self.n_members += 1
+
+    # true if members have been saved since the last checkpoint
+    def dirty(self):
+        return self.n_members > self.n_committed
+
+    # record a checkpoint covering every member saved so far
+    def save(self, ebook, process_state):
+        state = { 'key':self.key,
+                  'n_members':self.n_members,
+                  'ebook':ebook.get_state(),
+                  'process':process_state }
+        common.write_atomically(self.state_path,
+                                lambda f: json.dump(state, f))
+        self.n_committed = self.n_members
+
+    def close(self):
+        if self.log is not None:
+            self.log.close()
+            self.log = None
+
+    # the book's done - the checkpoints aren't needed
+    def remove(self):
+        self.close()
+        if os.path.exists(self.work_dir):
+            shutil.rmtree(self.work_dir)
+
+if __name__ == '__main__':
+    sys.stderr.write('I\'m a module.  Don\'t run me directly!')
+    sys.exit(-1)
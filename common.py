@@ -1,8 +1,10 @@
 #!/usr/bin/python
 # -*- coding: utf-8 -*-
 
+import sys
 import os
 import re
+import thread
 from lxml import etree
 
 def get_book_id():
@@ -21,6 +23,29 @@ def tree_to_str(tree, xml_declaration=True):
                           xml_declaration=xml_declaration,
                           encoding='utf-8')
 
+# size and mtime of a source file, kept with what's made from it (a
+# cache next to the item, a checkpoint) to tell whether that's stale
+def source_stamp(path):
+    st = os.stat(path)
+    return { 'size':st.st_size, 'mtime':int(st.st_mtime) }
+
+# Make the file at path by calling write(f) on a temporary file next to
+# it, then renaming that into place, so that nobody reading path sees
+# half a file.  The temporary file's name is unique to this process and
+# thread, and it's removed if anything goes wrong.
+def write_atomically(path, write, mode='w'):
+    tmp_path = path + '.tmp%d.%d' % (os.getpid(), thread.get_ident())
+    f = open(tmp_path, mode)
+    try:
+        write(f)
+        f.close()
+        os.rename(tmp_path, path)
+    except:
+        f.close()
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
 if __name__ == '__main__':
     sys.stderr.write("I'm a module.  Don't run me directly!")
     sys.exit(-1)
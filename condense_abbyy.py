@@ -13,7 +13,7 @@ import common
 # showchars=False
 showchars=True
 
-from debug import debug, debugging, assert_d
+from debug import debug, debugging, assert_d, profiled
 
 ns='{http://www.abbyy.com/FineReader_xml/FineReader6-schema-v1.xml}'
 
@@ -163,6 +163,7 @@ synonyms = {
     'false':'F',
 }
 
+@profiled
 def condense_abbyy(xml, outfile='outfile.txt'): 
     try:
         out = sys.stdout
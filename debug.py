@@ -12,3 +12,67 @@ else:
         pass
     def assert_d(expr):
         pass
+
+# PROFILE=file samples the python stack while functions decorated with
+# @profiled run, and appends what it saw to file as collapsed stacks -
+# 'outer;inner;innermost count' lines, as flamegraph.pl and speedscope
+# read.  PROFILE_INTERVAL sets the sampling interval in seconds of CPU
+# time (default 0.01).  Only the main thread is sampled - that's where
+# signal handlers run.  Samples are written when the outermost
+# profiled call returns, so batch workers (which don't run atexit
+# handlers) leave theirs too; lines from several processes can share
+# a file.
+profiling = os.environ.get('PROFILE')
+
+if profiling:
+    import signal
+    import fcntl
+    profile_interval = float(os.environ.get('PROFILE_INTERVAL', '0.01'))
+    profile_samples = {}
+    profile_depth = [0]
+
+    def profile_sample(signum, frame):
+        names = []
+        while frame is not None:
+            code = frame.f_code
+            names.append(os.path.basename(code.co_filename) + ':'
+                         + code.co_name)
+            frame = frame.f_back
+        names.reverse()
+        stack = ';'.join(names)
+        profile_samples[stack] = profile_samples.get(stack, 0) + 1
+
+    def profile_write():
+        if len(profile_samples) == 0:
+            return
+        lines = ['%s %d\n' % (stack, count)
+                 for stack, count in profile_samples.items()]
+        profile_samples.clear()
+        f = open(profiling, 'a')
+        fcntl.flock(f, fcntl.LOCK_EX)
+        f.write(''.join(lines))
+        f.close()
+
+    def profiled(f):
+        def profiled_f(*args, **kwargs):
+            profile_depth[0] += 1
+            if profile_depth[0] == 1:
+                signal.signal(signal.SIGPROF, profile_sample)
+                # restart system calls the signal interrupts, rather
+                # than failing them with EINTR
+                signal.siginterrupt(signal.SIGPROF, False)
+                signal.setitimer(signal.ITIMER_PROF, profile_interval,
+                                 profile_interval)
+            try:
+                return f(*args, **kwargs)
+            finally:
+                profile_depth[0] -= 1
+                if profile_depth[0] == 0:
+                    signal.setitimer(signal.ITIMER_PROF, 0, 0)
+                    profile_write()
+        profiled_f.__name__ = f.__name__
+        profiled_f.__doc__ = f.__doc__
+        return profiled_f
+else:
+    def profiled(f):
+        return f
@@ -0,0 +1,171 @@
+#!/usr/bin/python
+
+import sys
+import os
+import errno
+import shutil
+import hashlib
+import thread
+
+from debug import debug, debugging, assert_d
+
+# A directory of files named by key, kept under a size budget by
+# throwing out the least recently used.  Several processes can share
+# one: files arrive by rename, so readers never see half of one, and a
+# file that vanishes (evicted by someone else) is just a miss.
+#
+# Entries live at cache_dir/ab/abcdef...suffix, where 'abcdef...' is
+# the key (a hex digest, say).  A hit bumps the entry's mtime, which
+# is what eviction goes by - atime isn't to be trusted.
+
+def hex_key(*parts):
+    h = hashlib.sha1()
+    for part in parts:
+        h.update(str(len(part)) + ':' + part)
+    return h.hexdigest()
+
+# unique to this process and thread
+def tmp_suffix():
+    return '.tmp%d.%d' % (os.getpid(), thread.get_ident())
+
+class DiskCache(object):
+    # Once the cache is over max_bytes, it's trimmed to low_water of
+    # that, so that the next few puts don't each have to scan it again.
+    low_water = 0.9
+
+    def __init__(self, cache_dir, max_bytes, suffix=''):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.suffix = suffix
+        # our idea of the cache's size, or None if we haven't looked;
+        # only a guess between evictions, as others may be adding too
+        self.size = None
+
+    def key_path(self, key):
+        return os.path.join(self.cache_dir, key[:2], key + self.suffix)
+
+    # path to the entry for key, or None
+    def lookup(self, key):
+        path = self.key_path(key)
+        try:
+            os.utime(path, None)
+        except OSError:
+            return None
+        return path
+
+    def get(self, key):
+        path = self.lookup(key)
+        if path is None:
+            return None
+        try:
+            f = open(path, 'rb')
+        except IOError:
+            return None
+        data = f.read()
+        f.close()
+        return data
+
+    def tmp_path(self, key):
+        path = self.key_path(key)
+        d = os.path.dirname(path)
+        if not os.path.isdir(d):
+            try:
+                os.makedirs(d)
+            except OSError, e:
+                if e.errno != errno.EEXIST:
+                    raise
+        return path + tmp_suffix()
+
+    def put(self, key, data):
+        tmp_path = self.tmp_path(key)
+        f = open(tmp_path, 'wb')
+        f.write(data)
+        f.close()
+        self.commit(key, tmp_path)
+
+    # put a copy of the file at src_path in the cache - a hard link if
+    # it's on the same filesystem.  The caller mustn't change the file
+    # in place afterwards.
+    def put_file(self, key, src_path):
+        tmp_path = self.tmp_path(key)
+        try:
+            os.link(src_path, tmp_path)
+        except OSError:
+            shutil.copyfile(src_path, tmp_path)
+        self.commit(key, tmp_path)
+
+    def commit(self, key, tmp_path):
+        size = os.path.getsize(tmp_path)
+        os.rename(tmp_path, self.key_path(key))
+        if self.size is None:
+            self.evict()
+        else:
+            self.size += size
+            if self.size > self.max_bytes:
+                self.evict()
+
+    # Make dest_path a copy of the entry for key (a hard link if
+    # possible), replacing whatever's there.  Returns False on a miss.
+    def copy_out(self, key, dest_path):
+        path = self.lookup(key)
+        if path is None:
+            return False
+        try:
+            if os.path.samefile(path, dest_path):
+                # already linked to it (rename would do nothing)
+                return True
+        except OSError:
+            pass
+        tmp_path = dest_path + tmp_suffix()
+        try:
+            try:
+                os.link(path, tmp_path)
+            except OSError, e:
+                if e.errno == errno.ENOENT:
+                    return False
+                shutil.copyfile(path, tmp_path)
+        except IOError:
+            # evicted while we copied
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            return False
+        os.rename(tmp_path, dest_path)
+        return True
+
+    # if we're over budget, remove least recently used entries until
+    # we're down to the low water mark
+    def evict(self):
+        entries = []
+        total = 0
+        for sub in os.listdir(self.cache_dir):
+            d = os.path.join(self.cache_dir, sub)
+            if not os.path.isdir(d):
+                continue
+            for name in os.listdir(d):
+                if '.tmp' in name:
+                    continue
+                path = os.path.join(d, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, path))
+                total += st.st_size
+        if total <= self.max_bytes:
+            self.size = total
+            return
+        target = int(self.max_bytes * self.low_water)
+        entries.sort()
+        for (mtime, size, path) in entries:
+            if total <= target:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+        self.size = total
+
+if __name__ == '__main__':
+    sys.stderr.write('I\'m a module.  Don\'t run me directly!')
+    sys.exit(-1)
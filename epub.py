@@ -5,25 +5,78 @@ from lxml import objectify
 
 import common
 import zipfile
+import zipstream
+import zlib
+import stats
+from collections import deque
 from datetime import datetime
 
 from debug import debug, debugging
 
+# Compression for members, by manifest media-type: None stores the
+# member as is, otherwise it's a zlib deflate level.  The None entry
+# covers media-types not listed.  Images are already compressed, so
+# deflating them again costs time and saves nothing.
+compression_presets = {
+    'default':{ 'image/jpeg':None,
+                'image/png':None,
+                'image/gif':None,
+                None:6 },
+    'fast':{ 'image/jpeg':None,
+             'image/png':None,
+             'image/gif':None,
+             None:1 },
+    'smallest':{ 'image/jpeg':None,
+                 'image/png':None,
+                 'image/gif':None,
+                 None:9 },
+    }
+
 class Book(object):
 
-    def __init__(self, epub_out, content_dir='OEBPS/', include_page_map=False):
+    # epub_out is a filename or a writable file object - which needn't
+    # be seekable, so the book can be streamed to stdout or a pipe as
+    # it's built.
+    # deflate_threads - if > 0, members are compressed on a pool of
+    # threads (zlib lets go of the GIL while it works) and written out
+    # in the order they were added.
+    # compression - the name of one of the compression_presets, or a
+    # dict like them.
+    # journal - if given, an object whose save_member(info, content) is
+    # called for every add_content, e.g. a checkpoint.Checkpoint.  It
+    # also needs open_member(info), returning a file to write content
+    # opened with open_content to, and commit_member(info) once it's
+    # written.
+    def __init__(self, epub_out, content_dir='OEBPS/', include_page_map=False,
+                 deflate_threads=0, compression='default', journal=None):
+        if isinstance(compression, basestring):
+            if compression not in compression_presets:
+                raise Exception('unknown compression preset "'
+                                + compression + '"')
+            compression = compression_presets[compression]
+        self.compression = compression
+        self.journal = journal
         self.include_page_map = include_page_map
         self.dt = datetime.now()
-        self.z = zipfile.ZipFile(epub_out, 'w')
+        self.z = zipstream.ZipWriter(epub_out)
+        self.pending = deque()
+        self.pool = None
+        if deflate_threads > 0:
+            from multiprocessing.pool import ThreadPool
+            self.pool = ThreadPool(deflate_threads)
+            # don't let compressed members pile up in memory
+            self.max_pending = 4 * deflate_threads
         self.add('mimetype', 'application/epub+zip', deflate=False)
         self.content_dir = content_dir
         self.nav_number = 1
 
         tree_str = make_container_info(content_dir)
-        self.add('META-INF/container.xml', tree_str)
+        self.add('META-INF/container.xml', tree_str,
+                 media_type='application/xml')
 
         # style sheet
-        self.add(self.content_dir + 'stylesheet.css', make_stylesheet())
+        self.add(self.content_dir + 'stylesheet.css', make_stylesheet(),
+                 media_type='text/css')
 
         # This file enables Adobe Digital Editions features,
         # if referenced by a content file.
@@ -65,7 +118,45 @@ class Book(object):
         #                'href':'title.html',
         #                'media-type':'application/xhtml+xml' },
         self.manifest_items.append(info)
-        self.add(self.content_dir + ''+info['href'], content)
+        self.add(self.content_dir + ''+info['href'], content,
+                 media_type=info['media-type'])
+        if self.journal is not None:
+            self.journal.save_member(info, content)
+
+    # For content too big to want in memory all at once: returns a
+    # file-like object to write the member's data to.  Close it before
+    # adding anything else.
+    def open_content(self, info):
+        self.manifest_items.append(info)
+        media_type = info['media-type']
+        level = self.compression.get(media_type, self.compression[None])
+        zinfo = self.make_zip_info(self.content_dir + info['href'], level)
+        journal_file = None
+        if self.journal is not None:
+            journal_file = self.journal.open_member(info)
+        writer = ContentWriter(self, info, zinfo, level, journal_file)
+        if self.pool is not None:
+            # written out in turn, behind the members queued before it
+            self.pending.append(writer)
+        return writer
+
+    # everything but the manifest (which is rebuilt by adding content
+    # again) needed to pick up building the book where we left off
+    def get_state(self):
+        return { 'spine_items':self.spine_items,
+                 'guide_items':self.guide_items,
+                 'page_items':self.page_items,
+                 'navpoints':self.navpoints,
+                 'nav_number':self.nav_number,
+                 'cover_id':self.cover_id }
+
+    def set_state(self, state):
+        self.spine_items = state['spine_items']
+        self.guide_items = state['guide_items']
+        self.page_items = state['page_items']
+        self.navpoints = state['navpoints']
+        self.nav_number = state['nav_number']
+        self.cover_id = state['cover_id']
 
     def add_cover_id(self, cover_id):
         # used for meta tag to flag
@@ -98,14 +189,68 @@ class Book(object):
                                  'type':type, 'playOrder':self.nav_number })
         self.nav_number += 1
 
-    def add(self, path, content_str, deflate=True):
+    def add(self, path, content_str, deflate=True, media_type=None):
+        if deflate:
+            level = self.compression.get(media_type, self.compression[None])
+        else:
+            level = None
+        info = self.make_zip_info(path, level)
+        if self.pool is None:
+            if level is None:
+                self.z.writestr(info, content_str)
+            else:
+                with stats.timed('deflate'):
+                    self.z.writestr(info, content_str, level)
+            stats.count_member(media_type, info.file_size, info.compress_size)
+            return
+        if level is not None:
+            result = self.pool.apply_async(deflate_member,
+                                           (content_str, level))
+        else:
+            result = None
+        self.pending.append((info, content_str, result, media_type))
+        self.write_pending(keep=self.max_pending)
+
+    def make_zip_info(self, path, level):
         info = zipfile.ZipInfo(path)
-        info.compress_type = (zipfile.ZIP_DEFLATED if deflate
+        info.compress_type = (zipfile.ZIP_DEFLATED if level is not None
                               else zipfile.ZIP_STORED)
         info.external_attr = 0666 << 16L # fix access
         info.date_time = (self.dt.year, self.dt.month, self.dt.day,
                           self.dt.hour, self.dt.minute, self.dt.second)
-        self.z.writestr(info, content_str)
+        return info
+
+    # write out members from the front of the queue whose compression
+    # has finished, waiting if need be until no more than 'keep' are
+    # left pending.
+    def write_pending(self, keep):
+        while len(self.pending) > 0:
+            if isinstance(self.pending[0], ContentWriter):
+                if not self.pending[0].write_blocks(len(self.pending) > keep):
+                    break
+                self.pending.popleft()
+                continue
+            info, content_str, result, media_type = self.pending[0]
+            if result is None:
+                self.z.writestr(info, content_str)
+            elif result.ready() or len(self.pending) > keep:
+                compressed, crc, size = result.get()
+                self.z.write_compressed(info, compressed, crc, size)
+            else:
+                break
+            stats.count_member(media_type, info.file_size, info.compress_size)
+            self.pending.popleft()
+
+    # stop without finishing the book, e.g. after an error.  The
+    # output is left without a zip directory, so won't pass for a
+    # complete epub.
+    def abort(self):
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
+        self.pending.clear()
+        self.z.abort()
 
     def finish(self, meta_info_items):
         tree_str = make_opf(meta_info_items,
@@ -114,17 +259,150 @@ class Book(object):
                             self.guide_items,
                             self.include_page_map,
                             self.cover_id)
-        self.add(self.content_dir + 'content.opf', tree_str)
+        self.add(self.content_dir + 'content.opf', tree_str,
+                 media_type='application/oebps-package+xml')
 
         tree_str = make_ncx(self.navpoints, self.page_items)
-        self.add(self.content_dir + 'toc.ncx', tree_str)
+        self.add(self.content_dir + 'toc.ncx', tree_str,
+                 media_type='application/x-dtbncx+xml')
 
         if self.include_page_map:
             tree_str = make_page_map(self.page_items)
-            self.add(self.content_dir + 'page-map.xml', tree_str)
-
+            self.add(self.content_dir + 'page-map.xml', tree_str,
+                     media_type='application/oebps-page-map+xml')
+
+        if self.pool is not None:
+            self.write_pending(keep=0)
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
         self.z.close()
 
+# What Book.open_content returns.  Without a deflate pool, what's
+# written goes straight into the zip member.  With one, it's cut into
+# blocks of block_size that are deflated on the pool, each ended with
+# a full flush so that they join up into one deflate stream (as pigz
+# does), and the writer waits in the book's pending queue to write
+# them out in order.
+class ContentWriter(object):
+    block_size = 128 * 1024
+
+    def __init__(self, book, info, zinfo, level, journal_file=None):
+        self.book = book
+        self.info = info
+        self.zinfo = zinfo
+        self.level = level
+        self.journal_file = journal_file
+        self.size = 0
+        self.closed = False
+        self.member = None
+        if book.pool is None:
+            if level is None:
+                self.member = book.z.open(zinfo)
+            else:
+                self.member = book.z.open(zinfo, level)
+        else:
+            self.buffer = []
+            self.buffered = 0
+            # (data, result of deflating it, or None if it's stored)
+            self.blocks = deque()
+
+    # (not timed as 'deflate' - this is called from within whatever's
+    # producing the content, which has its own stage)
+    def write(self, data):
+        if isinstance(data, unicode):
+            data = data.encode('utf-8')
+        if self.book.pool is None:
+            self.member.write(data)
+        else:
+            self.buffer.append(data)
+            self.buffered += len(data)
+            if self.buffered >= self.block_size:
+                self.add_block()
+        self.size += len(data)
+        if self.journal_file is not None:
+            self.journal_file.write(data)
+
+    # bytes written so far
+    def tell(self):
+        return self.size
+
+    def add_block(self):
+        data = ''.join(self.buffer)
+        self.buffer = []
+        self.buffered = 0
+        result = None
+        if self.level is not None:
+            result = self.book.pool.apply_async(deflate_block,
+                                                (data, self.level,
+                                                 self.closed))
+        self.blocks.append((data, result))
+        self.book.write_pending(keep=self.book.max_pending)
+        # don't let blocks pile up in memory either
+        if len(self.blocks) > self.book.max_pending:
+            self.book.write_pending(keep=0)
+
+    # Called from Book.write_pending once the members before this one
+    # are written: writes out the blocks deflated so far, waiting for
+    # them all if wait.  Returns True once the whole member's written.
+    def write_blocks(self, wait):
+        if self.member is None:
+            self.member = self.book.z.open(self.zinfo, compress=False)
+        while len(self.blocks) > 0:
+            data, result = self.blocks[0]
+            if result is None:
+                compressed = data
+            elif wait or result.ready():
+                compressed = result.get()
+            else:
+                return False
+            self.member.write_compressed(compressed, data)
+            self.blocks.popleft()
+        if not self.closed:
+            return False
+        self.close_member()
+        return True
+
+    def close_member(self):
+        self.member.close()
+        stats.count_member(self.info['media-type'], self.zinfo.file_size,
+                           self.zinfo.compress_size)
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        if self.book.pool is None:
+            self.close_member()
+        elif self.buffered > 0 or self.level is not None:
+            # a deflated member always needs its last block
+            self.add_block()
+        if self.journal_file is not None:
+            self.journal_file.close()
+            self.book.journal.commit_member(self.info)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if exc_type is None:
+            self.close()
+        return False
+
+def deflate_member(content_str, level=zlib.Z_DEFAULT_COMPRESSION):
+    with stats.timed('deflate'):
+        co = zlib.compressobj(level, zlib.DEFLATED, -15)
+        compressed = co.compress(content_str) + co.flush()
+    return compressed, zlib.crc32(content_str) & 0xffffffff, len(content_str)
+
+# deflate a block of a member being streamed; see ContentWriter
+def deflate_block(data, level, last):
+    with stats.timed('deflate'):
+        co = zlib.compressobj(level, zlib.DEFLATED, -15)
+        if last:
+            return co.compress(data) + co.flush(zlib.Z_FINISH)
+        return co.compress(data) + co.flush(zlib.Z_FULL_FLUSH)
+
 def make_container_info(content_dir='OEBPS/'):
     root = etree.Element('container',
                      version='1.0',
@@ -0,0 +1,421 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import sys
+import getopt
+import os
+import time
+import json
+import errno
+import socket
+import signal
+import threading
+import collections
+import SocketServer
+
+import abbyy_to_epub
+import process_abbyy
+
+from debug import debug, debugging, assert_d
+
+# A long-running converter: takes jobs over a unix socket and runs
+# each in a worker process forked from the daemon, which has the
+# converter and its libraries already loaded.  Submitting a book costs
+# a message and a fork rather than starting a python, and a job whose
+# worker dies (a segfault, the OOM killer) just fails.
+#
+# The protocol is a json object per line each way.  Requests:
+#   { "op":"submit", "book_id":ID, "book_path":DIR, "epub_out":PATH,
+#     "options":{...} }              options as for abbyy_to_epub.convert
+#   { "op":"status", "job":JOB }
+#   { "op":"wait", "job":JOB, "timeout":SECS }
+#   { "op":"list" }
+#   { "op":"shutdown" }               finish queued jobs, then exit
+# Replies have "ok":true and the answer, or "ok":false and "error".
+# A job's status is 'queued', 'running', 'ok' or 'failed'; finished
+# ones also have 'seconds' (and 'error' or 'stats', as in a batch
+# summary).
+#
+# Paths must be absolute - the daemon's working directory is its own.
+# Anyone who can connect can have the daemon write where it can, so
+# the socket is made readable and writable by its owner only.
+
+default_socket = os.path.expanduser('~/.abbyy_to_epub.sock')
+
+# seconds a client gives the daemon to answer (on top of any time a
+# 'wait' asks for)
+default_timeout = 30
+# seconds a client's 'wait' with no timeout asks for at a time
+wait_round = 60
+
+# options a job may give; see abbyy_to_epub.convert
+job_options = ('image_decoder', 'image_threads', 'deflate_threads',
+               'compression', 'chunk_bytes', 'running_heads', 'stats',
+               'cache_dir', 'cache_bytes', 'image_cache_dir',
+               'image_cache_bytes', 'checkpoint_dir')
+
+def usage():
+    sys.stderr.write("\n")
+    sys.stderr.write("Usage: epub_daemon.py [options] serve\n")
+    sys.stderr.write("       epub_daemon.py [options] submit book_id path_to_book_files out.epub\n")
+    sys.stderr.write("       epub_daemon.py [options] status|wait job\n")
+    sys.stderr.write("       epub_daemon.py [options] list|shutdown\n")
+    sys.stderr.write("  Runs abbyy_to_epub conversions for clients of a unix socket,\n")
+    sys.stderr.write("  or is such a client.\n")
+    sys.stderr.write("\n")
+    sys.stderr.write("  -s, --socket=PATH  socket to listen or connect on\n")
+    sys.stderr.write("                     (default ~/.abbyy_to_epub.sock)\n")
+    sys.stderr.write("  -j, --jobs=N       books converted at once (default 1)\n")
+    sys.stderr.write("  --max-queued=N     refuse jobs beyond N waiting or running\n")
+    sys.stderr.write("                     (default 100)\n")
+    sys.stderr.write("  --options=JSON     for submit: converter options, e.g.\n")
+    sys.stderr.write("                     '{\"image_decoder\":\"pillow\"}'\n")
+    sys.stderr.write("  --timeout=SECS     for wait: give up after SECS\n")
+
+def main(argv):
+    try:
+        opts, args = getopt.getopt(argv, "hs:j:",
+                                   ["help", "socket=", "jobs=", "max-queued=",
+                                    "options=", "timeout="])
+    except getopt.GetoptError:
+        usage()
+        sys.exit(-1)
+    socket_path = default_socket
+    jobs = 1
+    max_queued = 100
+    options = {}
+    timeout = None
+    for opt, arg in opts:
+        if opt in ('-h', '--help'):
+            usage()
+            sys.exit()
+        elif opt in ('-s', '--socket'):
+            socket_path = arg
+        elif opt in ('-j', '--jobs'):
+            jobs = int(arg)
+        elif opt == '--max-queued':
+            max_queued = int(arg)
+        elif opt == '--options':
+            options = json.loads(arg)
+        elif opt == '--timeout':
+            timeout = float(arg)
+    if len(args) == 0:
+        usage()
+        sys.exit(-1)
+    command = args[0]
+    if command == 'serve' and len(args) == 1:
+        serve(socket_path, jobs, max_queued)
+        return
+    if command == 'submit' and len(args) == 4:
+        request = { 'op':'submit',
+                    'book_id':args[1],
+                    'book_path':os.path.abspath(args[2]),
+                    'epub_out':os.path.abspath(args[3]),
+                    'options':options }
+    elif command in ('status', 'wait') and len(args) == 2:
+        request = { 'op':command, 'job':args[1] }
+        if command == 'wait':
+            request['timeout'] = timeout
+    elif command in ('list', 'shutdown') and len(args) == 1:
+        request = { 'op':command }
+    else:
+        usage()
+        sys.exit(-1)
+    client = Client(socket_path)
+    if command == 'wait' and timeout is None:
+        # in rounds, so that a daemon that's gone away isn't waited on
+        # forever
+        while True:
+            request['timeout'] = wait_round
+            reply = client.call(request)
+            if (not reply.get('ok')
+                or reply['job']['status'] in ('ok', 'failed')):
+                break
+    else:
+        reply = client.call(request)
+    json.dump(reply, sys.stdout, indent=1, sort_keys=True)
+    sys.stdout.write('\n')
+    if not reply.get('ok'):
+        sys.exit(1)
+    if command == 'wait' and reply['job']['status'] != 'ok':
+        sys.exit(1)
+
+class JobError(Exception):
+    pass
+
+class Daemon(object):
+    def __init__(self, jobs=1, max_queued=100, keep_finished=1000,
+                 poll_interval=0.1):
+        self.n_workers = jobs
+        self.max_queued = max_queued
+        self.keep_finished = keep_finished
+        self.poll_interval = poll_interval
+        self.lock = threading.Lock()
+        self.changed = threading.Condition(self.lock)
+        # job id -> status record
+        self.jobs = {}
+        self.finished = collections.deque()
+        self.n_active = 0
+        self.next_id = 1
+        # (job id, book) waiting for a worker
+        self.queue = collections.deque()
+        # job id -> abbyy_to_epub.BatchProcess
+        self.running = {}
+        self.closing = False
+        self.dispatcher = threading.Thread(target=self.dispatch)
+        self.dispatcher.daemon = True
+        self.dispatcher.start()
+
+    def submit(self, book_id, book_path, epub_out, options=None):
+        if options is None:
+            options = {}
+        for name in options.keys():
+            if name not in job_options:
+                raise JobError('unknown option ' + name)
+        for path in (book_path, epub_out):
+            if not os.path.isabs(path):
+                raise JobError('paths must be absolute: ' + path)
+        book = { 'book_id':book_id,
+                 'book_path':book_path,
+                 'epub_out':epub_out,
+                 'options':options }
+        with self.lock:
+            if self.closing:
+                raise JobError('shutting down')
+            if self.n_active >= self.max_queued:
+                raise JobError('too many jobs queued')
+            job_id = str(self.next_id)
+            self.next_id += 1
+            self.jobs[job_id] = { 'job':job_id,
+                                  'book_id':book_id,
+                                  'epub_out':epub_out,
+                                  'status':'queued',
+                                  'submitted':time.time() }
+            self.n_active += 1
+            self.queue.append((job_id, book))
+            self.changed.notify_all()
+        return job_id
+
+    # Starts queued jobs as workers come free, and notes when they
+    # finish - or die without finishing, which BatchProcess reports as
+    # a failure.
+    def dispatch(self):
+        with self.lock:
+            while True:
+                while (len(self.queue) > 0
+                       and len(self.running) < self.n_workers):
+                    job_id, book = self.queue.popleft()
+                    self.running[job_id] = abbyy_to_epub.BatchProcess(
+                        book, close_sockets=True)
+                    self.jobs[job_id]['status'] = 'running'
+                    self.changed.notify_all()
+                for job_id in sorted(self.running.keys(), key=int):
+                    result = self.running[job_id].poll()
+                    if result is not None:
+                        del self.running[job_id]
+                        self.done(job_id, result)
+                if self.closing and self.n_active == 0:
+                    return
+                self.changed.wait(self.poll_interval)
+
+    # with the lock held
+    def done(self, job_id, result):
+        job = self.jobs[job_id]
+        job['status'] = result['status']
+        job['seconds'] = result['seconds']
+        for name in ('error', 'stats'):
+            if result.get(name) is not None:
+                job[name] = result[name]
+        self.n_active -= 1
+        self.finished.append(job_id)
+        while len(self.finished) > self.keep_finished:
+            del self.jobs[self.finished.popleft()]
+        self.changed.notify_all()
+
+    def status(self, job_id):
+        with self.lock:
+            return self.get_job(job_id)
+
+    # wait until the job's finished, or timeout seconds (None for no
+    # limit) have passed
+    def wait(self, job_id, timeout=None):
+        if timeout is not None:
+            end = time.time() + timeout
+        with self.lock:
+            while True:
+                job = self.get_job(job_id)
+                if job['status'] in ('ok', 'failed'):
+                    return job
+                if timeout is None:
+                    # a timeout lets ^C in
+                    self.changed.wait(60)
+                else:
+                    left = end - time.time()
+                    if left <= 0:
+                        return job
+                    self.changed.wait(left)
+
+    def list(self):
+        with self.lock:
+            return [dict(self.jobs[job_id])
+                    for job_id in sorted(self.jobs.keys(), key=int)]
+
+    # with the lock held
+    def get_job(self, job_id):
+        job = self.jobs.get(job_id)
+        if job is None:
+            raise JobError('no such job ' + str(job_id))
+        return dict(job)
+
+    # let queued jobs finish
+    def close(self):
+        with self.lock:
+            self.closing = True
+            self.changed.notify_all()
+        self.dispatcher.join()
+
+    # stop the running jobs, and forget the queued ones
+    def terminate(self):
+        with self.lock:
+            self.closing = True
+            self.queue.clear()
+            for bp in self.running.values():
+                bp.terminate()
+            self.running.clear()
+            self.n_active = 0
+            self.changed.notify_all()
+        self.dispatcher.join()
+
+class RequestHandler(SocketServer.StreamRequestHandler):
+    def handle(self):
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                break
+            try:
+                request = json.loads(line)
+                if not isinstance(request, dict):
+                    raise JobError('a request is a json object')
+                reply = self.server.handle_request_obj(request)
+                reply['ok'] = True
+            except (JobError, ValueError, KeyError, TypeError), e:
+                reply = { 'ok':False, 'error':str(e) }
+            self.wfile.write(json.dumps(reply) + '\n')
+            self.wfile.flush()
+
+class Server(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, socket_path, daemon):
+        self.daemon = daemon
+        SocketServer.UnixStreamServer.__init__(self, socket_path,
+                                               RequestHandler)
+
+    def handle_request_obj(self, request):
+        op = request.get('op')
+        d = self.daemon
+        if op == 'submit':
+            return { 'job':d.submit(request['book_id'],
+                                    request['book_path'],
+                                    request['epub_out'],
+                                    request.get('options')) }
+        elif op == 'status':
+            return { 'job':d.status(str(request['job'])) }
+        elif op == 'wait':
+            return { 'job':d.wait(str(request['job']),
+                                  request.get('timeout')) }
+        elif op == 'list':
+            return { 'jobs':d.list() }
+        elif op == 'shutdown':
+            # not from this thread - shutdown() waits for serve_forever
+            t = threading.Thread(target=self.shutdown)
+            t.daemon = True
+            t.start()
+            return {}
+        raise JobError('unknown op ' + str(op))
+
+# Remove the socket at path if nothing's listening on it; raises an
+# Exception if something is.
+def clear_stale_socket(path):
+    if not os.path.exists(path):
+        return
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    s.settimeout(default_timeout)
+    try:
+        s.connect(path)
+    except socket.timeout:
+        raise Exception('something is holding ' + path
+                        + ' open, but not answering')
+    except socket.error, e:
+        if e.errno not in (errno.ECONNREFUSED, errno.ENOENT):
+            raise
+        os.remove(path)
+        return
+    finally:
+        s.close()
+    raise Exception('a daemon is already listening on ' + path)
+
+# get the converter ready before any workers are forked, so that each
+# starts warm
+def warm_up():
+    process_abbyy.Chunker.base_size()
+
+def serve(socket_path, jobs=1, max_queued=100):
+    clear_stale_socket(socket_path)
+    warm_up()
+    daemon = Daemon(jobs, max_queued)
+    # the socket's owner-only from the moment it's made, rather than
+    # after; no jobs can be running yet to be forked with this umask
+    old_umask = os.umask(0077)
+    try:
+        server = Server(socket_path, daemon)
+    except:
+        daemon.terminate()
+        raise
+    finally:
+        os.umask(old_umask)
+    # SIGTERM stops us as ^C does
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    try:
+        server.serve_forever()
+        server.server_close()
+        daemon.close()
+    except KeyboardInterrupt:
+        server.server_close()
+        daemon.terminate()
+    finally:
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+
+class Client(object):
+    def __init__(self, socket_path=default_socket, timeout=default_timeout):
+        self.socket_path = socket_path
+        self.timeout = timeout
+
+    def call(self, request):
+        timeout = self.timeout
+        if request.get('op') == 'wait':
+            if request.get('timeout') is None:
+                timeout = None
+            else:
+                timeout += request['timeout']
+        s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        s.settimeout(timeout)
+        try:
+            s.connect(self.socket_path)
+            f = s.makefile('rw')
+            f.write(json.dumps(request) + '\n')
+            f.flush()
+            line = f.readline()
+            f.close()
+        except socket.timeout:
+            raise Exception('no reply from ' + self.socket_path + ' in '
+                            + str(timeout) + 's')
+        finally:
+            s.close()
+        if not line:
+            raise Exception('no reply from ' + self.socket_path)
+        return json.loads(line)
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -6,19 +6,34 @@ import re
 import gzip
 import os
 import zipfile
+import threading
+import struct
+import mmap
+import zlib
 
 from lxml import etree
-from lxml import objectify
+
+import image_decode
+import scandata
+import stats
+import disk_cache
 
 from debug import debug, debugging, assert_d
 
+# image_cache - a disk_cache.DiskCache (see get_image_cache) for the
+# scaled page images we make, or None.
+# image_threads - threads for get_page_image_async, started when it's
+# first called.
 class Book(object):
-    def __init__(self, book_id, book_path):
+    def __init__(self, book_id, book_path, image_decoder='netpbm',
+                 image_cache=None, image_threads=4):
         self.book_id = book_id
         self.book_path = book_path
         if not os.path.exists(book_path):
             raise Exception('Can\'t find book path "' + book_path + '"')
         self.scandata = None
+        self.abbyy_columns = None
+        self.abbyy_index = None
         self.images_type = 'unknown'
         if os.path.exists(os.path.join(book_path, book_id + '_jp2.zip')):
             self.images_type = 'jp2.zip'
@@ -26,7 +41,70 @@ class Book(object):
             self.images_type = 'tif.zip'
 #         else:
 #             raise Exception('Can\'t find book images')
-        
+        # name of an image_decode decoder, or a decoder object
+        if isinstance(image_decoder, basestring):
+            image_decoder = image_decode.get_decoder(image_decoder)
+        self.image_decoder = image_decoder
+        self.image_cache = image_cache
+        self.images_zip = None
+        self.images_map = None
+        self.image_members = {}
+        # page images may be fetched from several threads at once
+        self.images_lock = threading.Lock()
+        self.image_threads = image_threads
+        self.image_pool = None
+        self.image_pool_lock = threading.Lock()
+        if self.images_type != 'unknown':
+            self.open_images()
+
+    # Open the page image archive once, and index its members by leaf
+    # number, so page image requests don't re-read the central
+    # directory of a (possibly multi-GB) zip every time.  The archive
+    # is also mapped into memory, for read_member.
+    def open_images(self):
+        in_img_type = self.images_type[:-len('.zip')]
+        zipf = os.path.join(self.book_path,
+                            self.book_id + '_' + self.images_type)
+        self.images_zip = zipfile.ZipFile(zipf, 'r')
+        try:
+            f = open(zipf, 'rb')
+            try:
+                self.images_map = mmap.mmap(f.fileno(), 0,
+                                            access=mmap.ACCESS_READ)
+            finally:
+                f.close()
+        except (EnvironmentError, ValueError, OverflowError):
+            # too big to map (on a 32 bit system, say) - we'll read
+            # through images_zip instead
+            self.images_map = None
+        leaf_re = re.compile('_(\\d+)\\.' + in_img_type + '$')
+        for info in self.images_zip.infolist():
+            m = leaf_re.search(info.filename)
+            if m is not None:
+                self.image_members[int(m.group(1))] = info
+
+    def close(self):
+        if self.image_pool is not None:
+            self.image_pool.terminate()
+            self.image_pool.join()
+            self.image_pool = None
+        if self.abbyy_index is not None:
+            self.abbyy_index.close()
+            self.abbyy_index = None
+        if self.images_map is not None:
+            self.images_map.close()
+            self.images_map = None
+        if self.images_zip is not None:
+            self.images_zip.close()
+            self.images_zip = None
+        self.image_members = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
+        return False
 
     def get_book_id(self):
         return self.book_id
@@ -45,51 +123,55 @@ class Book(object):
                 return sd_path
         raise Exception('No scandata found')
 
+    # parsed scandata - see scandata.py
     def get_scandata(self):
         if self.scandata is None:
-            scandata_path = self.get_scandata_path()
-            (base, ext) = os.path.splitext(scandata_path)
-            if ext.lower() == '.zip':
-                z = zipfile.ZipFile(scandata_path, 'r')
-                scandata_str = z.read('scandata.xml')
-                z.close()
-                self.scandata = objectify.fromstring(scandata_str)
-                self.scandata_pages = self.scandata.pageData.page
-            else:
-                self.scandata = objectify.parse(self.
-                                                get_scandata_path()).getroot()
-                self.scandata_pages = self.scandata.xpath('/book/pageData/page')
-            self.leaves = {}
-            for page in self.scandata_pages:
-                self.leaves[int(page.get('leafNum'))] = page
+            self.scandata = scandata.get_scandata(self)
         return self.scandata
 
     def get_scandata_pages(self):
-        self.get_scandata()
-        return self.scandata_pages
+        return self.get_scandata().pages
 
+    # scandata.Page for the i'th page, or None if scandata has no such page
     def get_page_scandata(self, i):
-        self.get_scandata()
-        return self.scandata_pages[int(i)]
-#     scandata_pages = scandata.xpath('/book/pageData/page')
-#     if scandata_pages is None or len(scandata_pages) == 0:
-#         scandata_pages = scandata.pageData.page
+        pages = self.get_scandata().pages
+        i = int(i)
+        if i < 0 or i >= len(pages):
+            return None
+        return pages[i]
 
     def get_page_data_from_leafno(self, leaf):
-        if leaf in self.leaves:
-            return self.leaves[leaf]
-        else:
-            return None
+        return self.get_scandata().leaves.get(leaf)
 
     def get_leafno_for_page(self, i):
-        return int(self.get_page_scandata(i).get('leafNum'))
+        return self.get_scandata().pages[int(i)].leafNum
 
     def get_metadata_path(self):
         return os.path.join(self.book_path, self.book_id + '_meta.xml')
 
+    def get_abbyy_path(self):
+        return os.path.join(self.book_path, self.book_id + '_abbyy.gz')
+
     def get_abbyy(self):
-        return gzip.open(os.path.join(self.book_path,
-                                      self.book_id + '_abbyy.gz'), 'rb')
+        return gzip.open(self.get_abbyy_path(), 'rb')
+
+    # page offsets into the ABBYY file - see abbyy_index
+    def get_abbyy_index(self):
+        if self.abbyy_index is None:
+            import abbyy_index
+            self.abbyy_index = abbyy_index.get_index(self)
+        return self.abbyy_index
+
+    # the i'th ABBYY <page> element, without parsing the pages before it
+    def get_abbyy_page(self, i):
+        return self.get_abbyy_index().get_page(i)
+
+    # columnar (numpy) form of the ABBYY file - see abbyy_columns
+    def get_abbyy_columns(self):
+        if self.abbyy_columns is None:
+            import abbyy_columns
+            self.abbyy_columns = abbyy_columns.get_columns(self)
+        return self.abbyy_columns
 
     # get python string with image data - from .jp2 image in zip
     # finds appropriate leaf number for supplied page index
@@ -99,73 +181,132 @@ class Book(object):
                        out_img_type='jpg'):
         leafno = self.get_leafno_for_page(i)
 #         debug()
-        if self.images_type == 'jp2.zip':
-            zipf = os.path.join(self.book_path,
-                                self.book_id + '_jp2.zip')
-            image_path = (self.book_id + '_jp2/' + self.book_id + '_'
-                          + str(leafno).zfill(4) + '.jp2')
-            in_img_type = 'jp2'
-        elif self.images_type == 'tif.zip':
-            zipf  = os.path.join(self.book_path,
-                                 self.book_id + '_tif.zip')
-            image_path = (self.book_id + '_tif/' + self.book_id + '_'
-                          + str(leafno).zfill(4) + '.tif')
-            in_img_type = 'tif'
-        else:
+        if self.images_zip is None:
             return None
-        try:
-            z = zipfile.ZipFile(zipf, 'r')
-            info = z.getinfo(image_path) # for to check it exists
-            z.close()
-        except KeyError:
+        info = self.image_members.get(leafno)
+        if info is None:
             return None
-        return image_from_zip(zipf, image_path,
+        in_img_type = self.images_type[:-len('.zip')]
+        cache_key = None
+        if self.image_cache is not None:
+            cache_key = image_cache_key(self.book_id, leafno, info,
+                                        width, height, quality, region,
+                                        out_img_type, self.image_decoder)
+        return image_from_zip(self.images_zip, info,
                               width, height, quality, region,
-                              in_img_type, out_img_type)
+                              in_img_type, out_img_type,
+                              self.image_decoder, self.images_lock,
+                              self.image_cache, cache_key, self.images_map)
+
+    # Start get_page_image(i, ...) on a thread - one of pool's, if
+    # given (a multiprocessing.pool.ThreadPool), or else the book's own.
+    # Returns an AsyncResult: its get() gives the image, or raises what
+    # get_page_image did (a failed or timed-out image tool, say).
+    def get_page_image_async(self, i, pool=None, **kwargs):
+        if pool is None:
+            pool = self.get_image_pool()
+        return pool.apply_async(self.get_page_image, (i,), kwargs)
+
+    def get_image_pool(self):
+        with self.image_pool_lock:
+            if self.image_pool is None:
+                from multiprocessing.pool import ThreadPool
+                self.image_pool = ThreadPool(self.image_threads)
+            return self.image_pool
+
+default_image_cache_bytes = 1024 * 1024 * 1024
+
+def get_image_cache(cache_dir, max_bytes=default_image_cache_bytes):
+    return disk_cache.DiskCache(cache_dir, max_bytes)
+
+# Scaled page images are keyed on the book and leaf, the image's size
+# and crc in the zip (in case it's been replaced), what we asked for,
+# and which decoder (and version) made it.
+def image_cache_key(book_id, leafno, info, width, height, quality, region,
+                    out_img_type, decoder):
+    return disk_cache.hex_key('page image 1', book_id, str(leafno),
+                              '%d %08x' % (info.file_size, info.CRC),
+                              '%dx%d q%d' % (width, height, quality),
+                              region, out_img_type,
+                              getattr(decoder, 'name', '?'),
+                              getattr(decoder, 'version', '?'))
 
-if not os.path.exists('/tmp/stdout.ppm'):
-    os.symlink('/dev/stdout', '/tmp/stdout.ppm')
- 
 # get python string with image data - from .jp2 image in zip
-def image_from_zip(zipf, image_path,
+# zipf is an open zipfile.ZipFile, and info the ZipInfo of the image.
+# If cache is given, look for the image there (under cache_key) before
+# decoding anything, and keep it there afterwards.  zip_map is the zip
+# file mapped into memory, if it is - see read_member.
+def image_from_zip(zipf, info,
                    width, height, quality, region,
-                   in_img_type, out_img_type):
-    if not os.path.exists(zipf):
-        raise Exception('Zipfile missing')
+                   in_img_type, out_img_type, decoder=None, lock=None,
+                   cache=None, cache_key=None, zip_map=None):
     if region != '{0.0,0.0},{1.0,1.0}':
         raise Exception('Um, only whole image grabbage supported 4 now')
+    if decoder is None:
+        decoder = image_decode.NetpbmDecoder()
+    if cache is not None:
+        with stats.timed('image_cache'):
+            image = cache.get(cache_key)
+        if image is not None:
+            return image
+    with stats.timed('image'):
+        image_data = read_member(zipf, info, lock, zip_map)
+        image = decoder.decode(image_data, in_img_type,
+                               width, height, quality, region, out_img_type)
+    # don't keep failures - the tools give us nothing when they fail
+    if cache is not None and image:
+        cache.put(cache_key, image)
+    return image
 
-    scale = ' | pnmscale -quiet -xysize ' + str(width) + ' ' + str(height)
-#     scale = ' | pamscale -quiet -xyfit ' + str(width) + ' ' + str(height)
-    if out_img_type == 'jpg':
-        cvt_to_out = ' | pnmtojpeg -quality ' + str(quality)
-    elif out_img_type == 'ppm':
-        cvt_to_out = ' | ppmtoppm -quiet'
-    else:
-        raise Exception('unrecognized out img type')
-    if in_img_type == 'jp2':
-        output = os.popen('unzip -p ' + zipf + ' ' + image_path
-                        + ' | kdu_expand -region "' + region + '"'
-                        +   ' -reduce 2 '
-                        +   ' -no_seek -i /dev/stdin -o /tmp/stdout.ppm'
-                        + ' | pnmscale -quiet '
-                        +   ' -xysize ' + str(width) + ' ' + str(height)
-                        + scale
-                        + cvt_to_out)
-    elif in_img_type == 'tif':
-        import tempfile
-        t_handle, t_path = tempfile.mkstemp()
-#         t_handle.close()
-        output = os.popen('unzip -p ' + zipf + ' ' + image_path
-                        + ' > ' + t_path)
-        output.read()
-        output = os.popen('tifftopnm -quiet ' + t_path
-#                         + ' | pamcut <blah> '
-                        + scale
-                        + cvt_to_out)
-    else:
-        raise Exception('unrecognized in img type')
-    return output.read()
+# The data of zip member info.  If the zip is mapped into memory
+# (zip_map, an mmap of the whole file), a stored member comes back as a
+# read-only buffer over the mapping, with no copying, and a deflated
+# one is inflated straight from it; neither needs the lock.  Otherwise
+# it's read with zipf, holding lock (a ZipFile can't be read from two
+# threads at once).
+def read_member(zipf, info, lock=None, zip_map=None):
+    if (zip_map is not None and not info.flag_bits & 0x1 # not encrypted
+        and info.compress_type in (zipfile.ZIP_STORED,
+                                   zipfile.ZIP_DEFLATED)):
+        start = member_data_offset(zip_map, info)
+        if start + info.compress_size <= len(zip_map):
+            if info.compress_type == zipfile.ZIP_STORED:
+                return buffer(zip_map, start, info.file_size)
+            return inflate_member(zip_map, start, info)
+    if lock is not None:
+        with lock:
+            return zipf.read(info)
+    return zipf.read(info)
+
+# where member info's data starts, after its local header (whose name
+# and extra field needn't be the same length as the central
+# directory's)
+def member_data_offset(zip_map, info):
+    start = info.header_offset
+    fields = struct.unpack(zipfile.structFileHeader,
+                           zip_map[start:start + zipfile.sizeFileHeader])
+    if fields[zipfile._FH_SIGNATURE] != zipfile.stringFileHeader:
+        raise Exception('bad local header for ' + info.filename)
+    return (start + zipfile.sizeFileHeader
+            + fields[zipfile._FH_FILENAME_LENGTH]
+            + fields[zipfile._FH_EXTRA_FIELD_LENGTH])
+
+def inflate_member(zip_map, start, info, chunk_size=1024 * 1024):
+    d = zlib.decompressobj(-15)
+    end = start + info.compress_size
+    out = []
+    crc = 0
+    for pos in xrange(start, end, chunk_size):
+        data = d.decompress(buffer(zip_map, pos, min(chunk_size, end - pos)))
+        crc = zlib.crc32(data, crc)
+        out.append(data)
+    data = d.flush()
+    crc = zlib.crc32(data, crc)
+    out.append(data)
+    data = ''.join(out)
+    if len(data) != info.file_size or crc & 0xffffffff != info.CRC:
+        raise Exception('bad CRC-32 for zip member ' + info.filename)
+    return data
 
 # ' | pnmscale -quiet -xysize ' + str(width) + ' ' + str(height)
 
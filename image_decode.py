@@ -0,0 +1,141 @@
+#!/usr/bin/python
+
+import sys
+import os
+import shutil
+import tempfile
+import StringIO
+import cStringIO
+
+import tool_runner
+
+from debug import debug, debugging, assert_d
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+# Page image decoders.  A decoder turns the raw data of a page image
+# (.jp2 or .tif, as found in the book's image zip) into a scaled .jpg
+# or .ppm, fitting within width x height.  The data may be a str, or a
+# read-only buffer (over the mapped zip - see iarchive.read_member).
+
+class NetpbmDecoder(object):
+    # external kdu_expand/tifftopnm + netpbm pipeline, run by
+    # tool_runner (so with a timeout, and a limit on how many run at
+    # once).  Anything the tools need on disk goes in a directory of
+    # the call's own, removed afterwards, so any number of decodes can
+    # run at once.
+    name = 'netpbm'
+    # bump when the output changes, to stale cached images
+    version = '1'
+
+    def __init__(self, timeout=None):
+        self.timeout = timeout
+
+    def decode(self, image_data, in_img_type, width, height, quality,
+               region, out_img_type):
+        scale = ['pnmscale', '-quiet', '-xysize', str(width), str(height)]
+#         scale = ['pamscale', '-quiet', '-xyfit', str(width), str(height)]
+        if out_img_type == 'jpg':
+            cvt_to_out = ['pnmtojpeg', '-quality', str(quality)]
+        elif out_img_type == 'ppm':
+            cvt_to_out = ['ppmtoppm', '-quiet']
+        else:
+            raise Exception('unrecognized out img type')
+        if in_img_type not in ('jp2', 'tif'):
+            raise Exception('unrecognized in img type')
+        work_dir = tempfile.mkdtemp(prefix='image_decode')
+        try:
+            if in_img_type == 'jp2':
+                # kdu_expand goes by the output file's extension, so
+                # give it a .ppm name for its stdout
+                out_path = os.path.join(work_dir, 'stdout.ppm')
+                os.symlink('/dev/stdout', out_path)
+                cmds = [['kdu_expand', '-region', region,
+                         '-reduce', '2',
+                         '-no_seek', '-i', '/dev/stdin', '-o', out_path],
+                        scale,
+                        cvt_to_out]
+            else:
+                # tifftopnm wants to seek in its input
+                t_path = os.path.join(work_dir, 'page.tif')
+                f = open(t_path, 'wb')
+                f.write(image_data)
+                f.close()
+                image_data = ''
+                cmds = [['tifftopnm', '-quiet', t_path],
+#                         ['pamcut', <blah>],
+                        scale,
+                        cvt_to_out]
+            return tool_runner.run_pipeline(cmds, image_data, self.timeout)
+        finally:
+            shutil.rmtree(work_dir, True)
+
+class PillowDecoder(object):
+    # in-process decoding with Pillow (and OpenJPEG, for .jp2)
+    name = 'pillow'
+    version = '1'
+
+    # don't go below the usual number of jp2 decomposition levels
+    max_reduce = 5
+
+    def __init__(self):
+        if Image is None:
+            raise Exception('Pillow image decoder needs PIL')
+        # Pillow's resampling can change between releases
+        import PIL
+        self.version = (PillowDecoder.version + '/'
+                        + getattr(PIL, '__version__',
+                                  getattr(Image, 'VERSION', '?')))
+
+    def decode(self, image_data, in_img_type, width, height, quality,
+               region, out_img_type):
+        if in_img_type not in ('jp2', 'tif'):
+            raise Exception('unrecognized in img type')
+        if out_img_type not in ('jpg', 'ppm'):
+            raise Exception('unrecognized out img type')
+        # (cStringIO, as it reads from a buffer without copying it)
+        img = Image.open(cStringIO.StringIO(image_data))
+        (orig_width, orig_height) = img.size
+        fit = min(float(width) / orig_width, float(height) / orig_height)
+        if in_img_type == 'jp2':
+            # have OpenJPEG throw away resolution levels we don't need,
+            # rather than decoding them only to scale them away
+            reduce = 0
+            while (reduce < self.max_reduce
+                   and fit * 2 ** (reduce + 1) <= 1):
+                reduce += 1
+            img.reduce = reduce
+        img.load()
+        (w, h) = img.size
+        # like pnmscale -xysize: largest size that fits, same aspect
+        fit = min(float(width) / w, float(height) / h)
+        size = (max(1, int(round(w * fit))), max(1, int(round(h * fit))))
+        if size != img.size:
+            img = img.resize(size, Image.ANTIALIAS)
+        out = StringIO.StringIO()
+        if out_img_type == 'jpg':
+            if img.mode not in ('L', 'RGB'):
+                img = img.convert('RGB')
+            img.save(out, 'JPEG', quality=quality)
+        else:
+            if img.mode != 'RGB':
+                img = img.convert('RGB')
+            img.save(out, 'PPM')
+        return out.getvalue()
+
+decoders = {
+    'netpbm':NetpbmDecoder,
+    'pillow':PillowDecoder,
+}
+
+def get_decoder(name):
+    if name not in decoders:
+        raise Exception('unknown image decoder "' + name + '"')
+    return decoders[name]()
+
+if __name__ == '__main__':
+    sys.stderr.write('I\'m a module.  Don\'t run me directly!')
+    sys.exit(-1)
@@ -7,6 +7,9 @@ import re
 import os
 import gzip
 import zipfile
+import multiprocessing
+import collections
+import itertools
 
 from lxml import etree
 from lxml import objectify
@@ -18,8 +21,10 @@ import epub
 import common
 
 import iarchive
+import abbyy_text
+import stats
 
-from debug import debug, debugging, assert_d
+from debug import debug, debugging, assert_d, profiled
 # 'some have optional attributes'
 #     *  creator, contributor
 #           o opf:role — see http://www.loc.gov/marc/relators/ for values
@@ -66,57 +71,179 @@ def get_meta_items(iabook):
                 result.append({ 'item':dc_ns+tagname, 'text':tag.text })
     return result
 
-def process_book(iabook, ebook):
+# image_threads - number of threads decoding page images ahead of
+# the text pass; 0 decodes each image when it's needed.
+# text_pool - a pool of text_workers processes, from start_text_pool,
+# pulling text out of ranges of ABBYY pages in parallel; without one
+# the text is pulled out here.  The caller terminates it.
+# checkpoint - a checkpoint.Checkpoint to resume from, if it has
+# anything saved, and to save progress to as we go.
+# chunk_bytes - about how big to make each partNNNN.html; see Chunker.
+# skip_pars - a set of (page index, paragraph index) to leave out, e.g.
+# from running_heads.find_running_heads; if None, a page's first
+# paragraph is left out if abbyy_text.par_is_header says so.
+@profiled
+def process_book(iabook, ebook, image_threads=4, text_pool=None,
+                 text_workers=1, checkpoint=None, chunk_bytes=None,
+                 skip_pars=None):
+    pages = None
+    images = None
+    try:
+        resume = None
+        if checkpoint is not None:
+            resume = checkpoint.restore(ebook)
+        first_page = resume['page'] if resume is not None else 0
+        if text_pool is not None:
+            pages = parallel_pages(iabook, text_pool, text_workers,
+                                   first_page)
+        elif first_page > 0:
+            # skip to the page we're resuming at without parsing the rest
+            index = iabook.get_abbyy_index()
+            pages = abbyy_text.iter_pages_chunks(
+                index.iter_document_from(first_page))
+        images = ImagePrefetcher(iabook,
+                                 [i for i in plan_page_images(iabook)
+                                  if i >= first_page],
+                                 image_threads)
+        process_pages(iabook, ebook, images, pages, checkpoint, resume,
+                      chunk_bytes, skip_pars)
+    finally:
+        if images is not None:
+            images.close()
+
+# Processes for process_book's text_pool, or None if workers <= 1.
+# Start them before anything starts threads - epub.Book's deflate
+# pool, say - as a thread holding a lock when we fork would leave it
+# held for good in the child.
+def start_text_pool(workers):
+    if workers <= 1:
+        return None
+    return multiprocessing.Pool(workers)
+
+# Split the ABBYY file into ranges of pages, using its page index, and
+# have pool pull the text out of each range in a separate process.
+# Yields abbyy_text.PageTexts in page order, as iter_pages would,
+# starting from page first_page.
+#
+# We inflate the file, once, and send each range's bytes to the pool
+# as we get to them, keeping a couple of ranges per worker in hand.
+def parallel_pages(iabook, pool, workers, first_page=0):
+    index = iabook.get_abbyy_index()
+    n_pages = len(index.pages)
+    if first_page >= n_pages:
+        return
+    # a few ranges per worker, to even out the load
+    range_size = max(1, (n_pages - first_page) / (workers * 4) + 1)
+    starts = []
+    counts = []
+    for i in range(first_page, n_pages, range_size):
+        starts.append(index.pages[i][0])
+        counts.append(min(i + range_size, n_pages) - i)
+    pending = collections.deque()
+    n_ranges = 0
+    for data, count in itertools.izip(iter_ranges(index, starts), counts):
+        n_ranges += 1
+        if n_ranges < len(starts):
+            doc = index.prelude + data + '</document>'
+        else:
+            # the last range runs to the end of the file, </document>
+            # and all
+            doc = index.prelude + data
+        pending.append((pool.apply_async(extract_page_range, (doc,)), count))
+        if len(pending) >= workers * 2:
+            for page in range_results(*pending.popleft()):
+                yield page
+    while len(pending) > 0:
+        for page in range_results(*pending.popleft()):
+            yield page
+    if n_ranges < len(starts):
+        raise Exception('ABBYY file ends before the pages its index has')
+
+# Bytes of the ABBYY file from each offset in starts up to the next,
+# and from the last to the end of the file.  Ranges meet, so that
+# anything between the pages the index knows of is parsed too - and a
+# page it missed is noticed, by range_results.
+def iter_ranges(index, starts):
+    k = 0
+    pos = starts[0]
+    parts = []
+    for chunk in index.iter_from(starts[0]):
+        while k + 1 < len(starts) and pos + len(chunk) >= starts[k + 1]:
+            cut = starts[k + 1] - pos
+            parts.append(chunk[:cut])
+            yield ''.join(parts)
+            parts = []
+            chunk = chunk[cut:]
+            pos += cut
+            k += 1
+        parts.append(chunk)
+        pos += len(chunk)
+    yield ''.join(parts)
+
+def range_results(result, count):
+    range_pages = result.get()
+    # a page the index missed would shift every page after it
+    if len(range_pages) != count:
+        raise Exception('ABBYY page index is out of step with the '
+                        'file: expected %d pages, parsed %d'
+                        % (count, len(range_pages)))
+    return range_pages
+
+# doc is a range of pages, as a document that parses on its own
+def extract_page_range(doc):
+    return list(abbyy_text.iter_pages_chunks([doc]))
+
+# pages - iterable of abbyy_text.PageTexts for the whole book (or from
+# the page we're resuming at); by default, parsed from the ABBYY file
+# as we go.
+# resume - converter state saved with a checkpoint, to carry on from.
+def process_pages(iabook, ebook, images, pages=None, checkpoint=None,
+                  resume=None, chunk_bytes=None, skip_pars=None):
     aby_ns="{http://www.abbyy.com/FineReader_xml/FineReader6-schema-v1.xml}"
-    scandata = iabook.get_scandata()
     metadata = objectify.parse(iabook.get_metadata_path()).getroot()
     aby_file = iabook.get_abbyy()
 
-    bookData = scandata.find('bookData')
-    # XXX should fix below and similar by ensuring that scandata is always the same fmt...
-    # scandata.zip/scandata.xml parses different?
-    if bookData is None:
-        bookData = scandata.bookData
-
     # some books no scanlog
 #     scanLog = scandata.find('scanLog')
 #     if scanLog is None:
 #         scanLog = scandata.scanLog
 
-    paragraphs = []
     i = 0
     part_number = 0
     cover_number = 0
     nav_number = 0
-    context = etree.iterparse(aby_file,
-                              tag=aby_ns+'page',
-                              resolve_entities=False)
+    if pages is None:
+        pages = abbyy_text.iter_pages(aby_file)
+    pages = stats.timed_iter('parse', pages)
     found_title = False
     for page_scandata in iabook.get_scandata_pages(): #confirm title exists
-        t = page_scandata.pageType.text
+        t = page_scandata.pageType
         if t == 'Title' or t == 'Title Page':
             found_title = True
             break
     # True if no title found, else False now, True later.
     before_title_page = found_title
-    for event, page in context:
+    if resume is not None:
+        i = resume['page']
+        part_number = resume['part_number']
+        cover_number = resume['cover_number']
+        before_title_page = resume['before_title_page']
+    chunker = Chunker(ebook, chunk_bytes, part_number)
+    for page in pages:
         page_scandata = iabook.get_page_scandata(i)
-        def include_page(page_scandata):
-            if page_scandata is None:
-                return False
-            add = page_scandata.find('addToAccessFormats')
-            if add is None:
-                add = page_scandata.addToAccessFormats
-            if add is not None and add.text == 'true':
-                return True
-            else:
-                return False
         if not include_page(page_scandata):
             i += 1
             continue
-        page_type = page_scandata.pageType.text.lower()
+        page_type = page_scandata.pageType.lower()
+        # Page images can't go into the zip while a chunk is being
+        # written to it - finish the chunk first.  That keeps the spine
+        # in page order, too.
+        if (page_type in ('cover', 'title', 'title page', 'copyright',
+                          'contents')
+            or (page_type == 'normal' and before_title_page)):
+            chunker.flush()
         if page_type == 'cover':
-            (id, filename) = make_html_page_image(i, iabook, ebook)
+            (id, filename) = make_html_page_image(i, iabook, ebook, images)
             if cover_number == 0:
                 cover_title = 'Front Cover'
             else:
@@ -129,32 +256,33 @@ def process_book(iabook, ebook):
                 ebook.add_cover_id(id)
 
                 # Add intro page after 1rst cover page
-                tree = make_html('Archive',
-                     [E.p('This book made available by the Internet Archive.')])
+                with stats.timed('html'):
+                    tree = make_html('Archive',
+                         [E.p('This book made available by the Internet Archive.')])
+                    tree_str = common.tree_to_str(tree, xml_declaration=False)
                 ebook.add_content({ 'id':'intro',
                                     'href':'intro.html',
                                     'media-type':'application/xhtml+xml' },
-                                  common.tree_to_str(tree,
-                                                     xml_declaration=False))
+                                  tree_str)
                 ebook.add_spine_item({ 'idref':'intro' })
 
             cover_number += 1
 
         elif page_type == 'title' or page_type == 'title page':
             before_title_page = False
-            (id, filename) = make_html_page_image(i, iabook, ebook)
+            (id, filename) = make_html_page_image(i, iabook, ebook, images)
             ebook.add_navpoint( { 'text':'Title Page', 'content':filename } )
             ebook.add_guide_item( { 'href':filename,
                                     'type':'title-page',
                                     'title':'Title Page' } )
         elif page_type == 'copyright':
-            (id, filename) = make_html_page_image(i, iabook, ebook)
+            (id, filename) = make_html_page_image(i, iabook, ebook, images)
             ebook.add_navpoint( { 'text':'Copyright', 'content':filename } )
             ebook.add_guide_item( { 'href':filename,
                                     'type':'copyright-page',
                                     'title':'Title Page' } )
         elif page_type == 'contents':
-            (id, filename) = make_html_page_image(i, iabook, ebook)
+            (id, filename) = make_html_page_image(i, iabook, ebook, images)
             ebook.add_navpoint( { 'text':'Contents', 'content':filename } )
             ebook.add_guide_item( { 'href':filename,
                                     'type':'toc',
@@ -165,126 +293,196 @@ def process_book(iabook, ebook):
             if before_title_page:
                 # XXX consider skipping if blank + no words?
                 # make page image
-                (id, filename) = make_html_page_image(i, iabook, ebook)
+                (id, filename) = make_html_page_image(i, iabook, ebook, images)
             else:
-                first_par = True
-                for block in page:
-                    if block.get('blockType') == 'Text':
-                        pass
-                    else:
-                        pass
-                    for el in block:
-                        if el.tag == aby_ns+'region':
-                            for rect in el:
-                                pass
-                        elif el.tag == aby_ns+'text':
-                            for par in el:
-                                def par_is_header(par):
-                                    # if:
-                                    #   it's the first on the page
-                                    #   there's only one line
-                                    #   on that line, there's a formatting tag, s.t.
-                                    #   - it has < 6 charParam kids
-                                    #   - each is wordNumeric
-                                    # then:
-                                    #   Skip it!
-                                    if len(par) != 1:
-                                        return False
-                                    line = par[0]
-                                    for fmt in line:
-                                        if len(fmt) > 6:
-                                            continue
-                                        saw_non_num = False
-                                        for cp in fmt:
-                                            if cp.get('wordNumeric') != 'true':
-                                                saw_non_num = True
-                                                break
-                                        if not saw_non_num:
-                                            return True
-                                        hdr_text = etree.tostring(fmt,
-                                                              method='text',
-                                                              encoding=unicode)
-                                        rnums = ['i', 'ii', 'iii', 'iv',
-                                                 'v', 'vi', 'vii', 'viii',
-                                                 'ix', 'x', 'xi', 'xii',
-                                                 'xiii', 'xiv', 'xv', 'xvi',
-                                                 'xvii', 'xviii', 'xix', 'xx',
-                                                 'xxi', 'xxii',
-                                                 ]
-                                        if hdr_text in rnums:
-                                            return True
-                                    return False
-                                if first_par and par_is_header(par):
-                                    first_par = False
-                                    continue
-                                first_par = False
-                                lines = []
-                                prev_line = ''
-                                for line in par:
-                                    for fmt in line:
-                                        fmt_text = etree.tostring(fmt,
-                                                                  method='text',
-                                                                  encoding=unicode)
-                                        if len(fmt_text) > 0:
-                                            if prev_line[-1:] == '-':
-                                                if fmt[0].get('wordStart') == 'false':
-                                                    # ? and wordFromDictionary = true ?
-                                                    lines.append(prev_line[:-1])
-                                                else:
-                                                    lines.append(prev_line)
-                                            else:
-                                                lines.append(prev_line)
-                                                lines.append(' ')
-                                            prev_line = fmt_text
-                                lines.append(prev_line)
-                                paragraphs.append(E.p(''.join(lines)))
-                        elif (el.tag == aby_ns+'row'):
-                            pass
-                        else:
-                            print('unexpected tag type' + el.tag)
-                            sys.exit(-1)
-
-        page.clear()
+                if len(page.unexpected) > 0:
+                    print('unexpected tag type' + aby_ns + page.unexpected[0])
+                    sys.exit(-1)
+                with stats.timed('text'):
+                    texts = []
+                    for j, par in enumerate(page.pars):
+                        if skip_pars is not None:
+                            if (i, j) in skip_pars:
+                                continue
+                        elif j == 0 and abbyy_text.par_is_header(par):
+                            continue
+                        texts.append(abbyy_text.par_text(par))
+                for text in texts:
+                    chunker.add(text)
+
         i += 1
+        chunker.end_page()
 
-        if len(paragraphs) > 100:
-            # make a chunk!
-            part_str = 'part' + str(part_number).zfill(4)
-            part_str_href = part_str + '.html'
-            tree = make_html('sample title', paragraphs)
-            ebook.add_content({ 'id':part_str,
-                                'href':part_str_href,
-                                'media-type':'application/xhtml+xml' },
-                              common.tree_to_str(tree, xml_declaration=False))
-            ebook.add_spine_item({ 'idref':part_str })
-            ebook.add_page_map_item(i, part_str_href)
-            if part_number == 0:
-                ebook.add_guide_item( { 'href':part_str_href,
-                                        'type':'text',
-                                        'title':'Book' } )
-                ebook.add_navpoint({ 'text':'Pages',
-                                     'content':part_str_href })
-            part_number += 1
-            paragraphs = []
+        # everything up to here is in the book - note where we are
+        if (checkpoint is not None and chunker.empty()
+            and checkpoint.dirty()):
+            checkpoint.save(ebook, { 'page':i,
+                                     'part_number':chunker.part_number,
+                                     'cover_number':cover_number,
+                                     'before_title_page':before_title_page })
     # make chunk from last paragraphs
-    if len(paragraphs) > 100:
-        part_str = 'part' + str(part_number).zfill(4)
+    chunker.flush()
+
+# default target size of a text chunk, in bytes of xhtml.  Smaller
+# chunks turn pages faster on readers with little memory to spare.
+default_chunk_bytes = 64 * 1024
+
+# Writes paragraphs of text into partNNNN.html chunks of about
+# target_bytes of xhtml each.  A chunk is finished at the first page
+# boundary after it reaches target_bytes, or - if a page is long -
+# before the paragraph that would take it past max_bytes.  The size is
+# added up paragraph by paragraph from what serialising will write.
+#
+# Each paragraph is serialised as it comes, straight into the chunk's
+# zip member (see chunk_writer), so a chunk is never held in memory
+# whole.  Nothing else can be added to the epub while a chunk is open;
+# flush() it first.
+class Chunker(object):
+    # '      <p>' + text + '</p>\n', as make_html pretty-prints it
+    par_overhead = len('      <p></p>\n')
+    # the rest of a chunk - worked out once, by base_size()
+    chunk_overhead = None
+
+    def __init__(self, ebook, target_bytes=None, part_number=0):
+        if target_bytes is None:
+            target_bytes = default_chunk_bytes
+        self.ebook = ebook
+        self.target_bytes = target_bytes
+        self.max_bytes = target_bytes + target_bytes / 2
+        self.part_number = part_number
+        self.out = None
+        self.writer = None
+        self.size = self.base_size()
+
+    @classmethod
+    def base_size(cls):
+        if cls.chunk_overhead is None:
+            tree = make_html('sample title', [E.p('x')])
+            cls.chunk_overhead = (len(common.tree_to_str(tree,
+                                                         xml_declaration=False))
+                                  - cls.par_overhead - 1)
+        return cls.chunk_overhead
+
+    def empty(self):
+        return self.writer is None
+
+    def add(self, text):
+        size = (len(text.encode('utf-8')) + self.par_overhead
+                + 4 * text.count('&') + 3 * text.count('<')
+                + 3 * text.count('>'))
+        if self.writer is not None and self.size + size > self.max_bytes:
+            self.flush()
+        if self.writer is None:
+            self.open()
+        with stats.timed('html'):
+            self.writer.send(text)
+        self.size += size
+
+    def end_page(self):
+        if self.size >= self.target_bytes:
+            self.flush()
+
+    def open(self):
+        part_str = 'part' + str(self.part_number).zfill(4)
+        self.out = self.ebook.open_content({ 'id':part_str,
+                                             'href':part_str + '.html',
+                                             'media-type':
+                                                 'application/xhtml+xml' })
+        self.writer = chunk_writer(self.out, 'sample title')
+        self.writer.next()
+
+    # finish the chunk we're writing, if any
+    def flush(self):
+        if self.writer is None:
+            return
+        ebook = self.ebook
+        part_str = 'part' + str(self.part_number).zfill(4)
         part_str_href = part_str + '.html'
-        tree = make_html('sample title', paragraphs)
-        ebook.add_content({ 'id':part_str,
-                            'href':part_str_href,
-                            'media-type':'application/xhtml+xml' },
-                          common.tree_to_str(tree, xml_declaration=False))
+        with stats.timed('html'):
+            try:
+                self.writer.send(None)
+            except StopIteration:
+                pass
+        assert_d(self.out.tell() == self.size)
+        self.out.close()
         ebook.add_spine_item({ 'idref':part_str })
-        if part_number == 0:
-            book.add_guide_item( { 'href':part_str_href,
+        if self.part_number == 0:
+            ebook.add_guide_item( { 'href':part_str_href,
                                     'type':'text',
                                     'title':'Book' } )
             ebook.add_navpoint({ 'text':'Pages',
                                  'content':part_str_href })
+        self.part_number += 1
+        self.out = None
+        self.writer = None
+        self.size = self.base_size()
+
+def include_page(page_scandata):
+    if page_scandata is None:
+        return False
+    return page_scandata.addToAccessFormats
 
-def make_html_page_image(i, iabook, ebook):
-    image = iabook.get_page_image(i, width=600, height=800, quality=90)
+# Work out, from scandata alone, which pages process_pages will turn
+# into page images: covers, title, copyright and contents pages, and
+# any normal pages before the title page.  Returns page indices, in
+# the order they'll be needed.
+def plan_page_images(iabook):
+    found_title = False
+    for page_scandata in iabook.get_scandata_pages():
+        t = page_scandata.pageType
+        if t == 'Title' or t == 'Title Page':
+            found_title = True
+            break
+    before_title_page = found_title
+    plan = []
+    for i, page_scandata in enumerate(iabook.get_scandata_pages()):
+        if not include_page(page_scandata):
+            continue
+        page_type = page_scandata.pageType.lower()
+        if page_type == 'title' or page_type == 'title page':
+            before_title_page = False
+            plan.append(i)
+        elif page_type in ('cover', 'copyright', 'contents'):
+            plan.append(i)
+        elif page_type == 'normal' and before_title_page:
+            plan.append(i)
+    return plan
+
+page_image_args = { 'width':600, 'height':800, 'quality':90 }
+
+# Decodes planned page images on a pool of threads, so that the
+# image tools (or Pillow, which releases the GIL while decoding) run
+# while the main thread gets on with parsing text.
+class ImagePrefetcher(object):
+    def __init__(self, iabook, pages, threads=4):
+        self.iabook = iabook
+        self.pending = {}
+        self.pool = None
+        if threads > 0 and len(pages) > 0:
+            from multiprocessing.pool import ThreadPool
+            self.pool = ThreadPool(threads)
+            for i in pages:
+                self.pending[i] = iabook.get_page_image_async(
+                    i, pool=self.pool, **page_image_args)
+
+    def get(self, i):
+        result = self.pending.pop(i, None)
+        if result is None:
+            return self.iabook.get_page_image(i, **page_image_args)
+        return result.get()
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
+        self.pending = {}
+
+def make_html_page_image(i, iabook, ebook, images=None):
+    if images is not None:
+        image = images.get(i)
+    else:
+        image = iabook.get_page_image(i, **page_image_args)
     leaf_id = 'leaf' + str(i).zfill(4)
     leaf_image_id = 'leaf-image' + str(i).zfill(4)
     ebook.add_content({ 'id':leaf_image_id,
@@ -293,11 +491,13 @@ def make_html_page_image(i, iabook, ebook):
                        image);
     img_tag = E.img({ 'src':'images/' + leaf_image_id + '.jpg',
                       'alt':'leaf ' + str(i) })
-    tree = make_html('leaf ' + str(i).zfill(4), [ img_tag ])
+    with stats.timed('html'):
+        tree = make_html('leaf ' + str(i).zfill(4), [ img_tag ])
+        tree_str = common.tree_to_str(tree, xml_declaration=False)
     ebook.add_content({ 'id':leaf_id,
                         'href':leaf_id + '.html',
                         'media-type':'application/xhtml+xml' },
-                      common.tree_to_str(tree, xml_declaration=False))
+                      tree_str)
     ebook.add_spine_item({ 'idref':leaf_id, 'linear':'no' })
 
     return leaf_id, leaf_id + '.html'
@@ -312,29 +512,58 @@ def make_page_image(i, iabook, ebook):
     ebook.add_spine_item({ 'idref':leaf_image_id, 'linear':'no' })
     return leaf_image_id, 'images/' + leaf_image_id + '.jpg'
 
+xhtml_ns = 'http://www.w3.org/1999/xhtml'
+
+def make_head(title):
+    return E.head(
+        E.title(title),
+        E.meta(name='generator', content='abbyy to epub tool, v0.1'),
+        E.link(rel='stylesheet',
+               href='stylesheet.css',
+               type='text/css'),
+#         E.link(rel='stylesheet',
+#                href='page-template.xpgt',
+#                type='application/vnd.adobe-page-template+xml'),
+        E.meta({'http-equiv':'Content-Type',
+            'content':'application/xhtml+xml; charset=utf-8'})
+    )
+
 def make_html(title, body_elems):
+    div = E.div({ 'class':'body' })
+    for el in body_elems:
+        div.append(el)
     html = E.html(
-        E.head(
-            E.title(title),
-            E.meta(name='generator', content='abbyy to epub tool, v0.1'),
-            E.link(rel='stylesheet',
-                   href='stylesheet.css',
-                   type='text/css'),
-#             E.link(rel='stylesheet',
-#                    href='page-template.xpgt',
-#                    type='application/vnd.adobe-page-template+xml'),
-            E.meta({'http-equiv':'Content-Type',
-                'content':'application/xhtml+xml; charset=utf-8'})
-        ),
-        E.body(
-            E.div({ 'class':'body' })
-        ),
-        xmlns='http://www.w3.org/1999/xhtml'
+        make_head(title),
+        E.body(div),
+        xmlns=xhtml_ns
     )
-    for el in body_elems:
-        html.xpath('/html/body/div')[0].append(el)
     return etree.ElementTree(html)
 
+# A generator that writes a page of paragraphs to out as it's sent
+# their text, laid out just as tree_to_str(make_html(title, ...))
+# would: send None to finish the page.
+def chunk_writer(out, title):
+    head = make_head(title)
+    head.text = '\n    '
+    for el in head:
+        el.tail = '\n    '
+    head[-1].tail = '\n  '
+    with etree.xmlfile(out, encoding='utf-8') as xf:
+        with xf.element('html', xmlns=xhtml_ns):
+            xf.write('\n  ', head, '\n  ')
+            with xf.element('body'):
+                xf.write('\n    ')
+                with xf.element('div', { 'class':'body' }):
+                    while True:
+                        text = yield
+                        if text is None:
+                            break
+                        xf.write('\n      ', E.p(text))
+                    xf.write('\n    ')
+                xf.write('\n  ')
+            xf.write('\n')
+    out.write('\n')
+
 if __name__ == '__main__':
     sys.stderr.write('I\'m a module.  Don\'t run me directly!')
     sys.exit(-1)
@@ -0,0 +1,137 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import sys
+import re
+import zlib
+
+import numpy
+
+import abbyy_text
+from abbyy_columns import WORD_NUMERIC, PAR_IN_TABLE
+
+from debug import debug, debugging, assert_d
+
+# Finds a book's running heads and feet - page numbers (folios), and
+# running titles like the book's or chapter's name - by looking at the
+# top and bottom of every page at once, using the geometry in
+# abbyy_columns, rather than at one page's first paragraph at a time
+# as abbyy_text.par_is_header does.
+#
+# The candidates on each page are its first and last paragraphs (not
+# counting those in tables), if they're a single line near the top or
+# bottom edge.  Of those,
+#   - folios are lines of no more than folio_max_chars numerals
+#     (arabic, or roman as in abbyy_text.rnums)
+#   - running titles are lines whose text, less case, punctuation and
+#     any numbers, repeats
+# and a group of them - the folios at one edge, or the lines at one
+# edge with the same text - counts if there are at least min_repeats
+# of them.  A line in a group that sits well away from where the rest
+# do isn't counted as one of them.
+#
+# The result is a set of (page index, paragraph index) pairs, with
+# paragraphs numbered as abbyy_text.PageText.pars are, for
+# process_abbyy.process_pages to leave out.
+
+min_repeats = 3
+# how far from the top or bottom of the page, as a fraction of its
+# height, a running head or foot can be
+edge_frac = 0.2
+# how far from the average position of its group, as a fraction of
+# page height, a line can be
+position_tolerance = 0.03
+folio_max_chars = 6
+
+TOP = 0
+BOTTOM = 1
+
+roman_re = re.compile(r'^m{0,4}(cm|cd|d?c{0,3})(xc|xl|l?x{0,3})(ix|iv|v?i{0,3})$')
+word_re = re.compile(r'[^\W\d_]+|\d+', re.UNICODE)
+
+# what's left of a line's text for comparing with others: lower case
+# words, without numbers
+def title_key(text):
+    words = [w for w in word_re.findall(text.lower())
+             if not w.isdigit() and not roman_re.match(w)]
+    return u' '.join(words)
+
+# Single-line first and last paragraphs of each page that are close
+# enough to its top or bottom.  Returns arrays of (page, paragraph
+# index within the page, line, edge, distance from the edge as a
+# fraction of page height).
+def edge_lines(cols):
+    text_pars = numpy.nonzero((cols.par_flags & PAR_IN_TABLE) == 0)[0]
+    # each page's text pars are text_pars[starts[i]:ends[i]]
+    starts = numpy.searchsorted(text_pars, cols.page_par[:-1])
+    ends = numpy.searchsorted(text_pars, cols.page_par[1:])
+    pages = numpy.nonzero((ends > starts) & (cols.page_size[:, 1] > 0))[0]
+    n = len(pages)
+    pages = numpy.concatenate([pages, pages])
+    indices = numpy.concatenate([starts[pages[:n]], ends[pages[n:]] - 1])
+    edges = numpy.concatenate([numpy.zeros(n, dtype='uint8') + TOP,
+                               numpy.zeros(n, dtype='uint8') + BOTTOM])
+    pars = text_pars[indices]
+    ordinals = indices - starts[pages]
+    lines = cols.par_line[pars]
+    one_line = cols.par_line[pars + 1] - lines == 1
+    boxes = cols.line_box[lines]
+    heights = cols.page_size[pages, 1].astype('float64')
+    distances = numpy.where(edges == TOP,
+                            boxes[:, 1] / heights,
+                            (heights - boxes[:, 3]) / heights)
+    keep = one_line & (distances < edge_frac)
+    return (pages[keep], ordinals[keep], lines[keep], edges[keep],
+            distances[keep])
+
+# For groups given by the numbers in groups (-1 for none), which lines
+# are in a group of at least min_repeats, at about its usual distance
+# from the edge.
+def repeated(groups, distances):
+    found = numpy.zeros(len(groups), dtype=bool)
+    member = groups >= 0
+    if not member.any():
+        return found
+    (ids, inverse, counts) = numpy.unique(groups[member],
+                                          return_inverse=True,
+                                          return_counts=True)
+    means = numpy.bincount(inverse, weights=distances[member]) / counts
+    found[member] = ((counts[inverse] >= min_repeats)
+                     & (abs(distances[member] - means[inverse])
+                        <= position_tolerance))
+    return found
+
+def find_running_heads(cols):
+    (pages, ordinals, lines, edges, distances) = edge_lines(cols)
+    # count each line's characters, and those that aren't numerals,
+    # from running totals over all the book's characters
+    visible = (cols.chars != 0) & (cols.chars != ord(' '))
+    n_visible = numpy.concatenate([[0], numpy.cumsum(visible)])
+    n_other = numpy.concatenate(
+        [[0], numpy.cumsum(visible & ((cols.char_flags & WORD_NUMERIC) == 0))])
+    first = cols.line_char[lines]
+    end = cols.line_char[lines + 1]
+    n_chars = n_visible[end] - n_visible[first]
+    folios = ((n_chars > 0) & (n_chars <= folio_max_chars)
+              & (n_other[end] == n_other[first]))
+
+    # the rest need the text
+    titles = numpy.zeros(len(lines), dtype='int64') - 1
+    for k in numpy.nonzero(~folios)[0]:
+        text = cols.line_text(lines[k]).strip()
+        if n_chars[k] <= folio_max_chars and text.lower() in abbyy_text.rnums:
+            folios[k] = True
+            continue
+        key = title_key(text)
+        if len(key) > 0:
+            crc = zlib.crc32(key.encode('utf-8')) & 0xffffffff
+            titles[k] = crc * 2 + edges[k]
+
+    found = (repeated(numpy.where(folios, edges.astype('int64'), -1),
+                      distances)
+             | repeated(titles, distances))
+    return set(zip(pages[found].tolist(), ordinals[found].tolist()))
+
+if __name__ == '__main__':
+    sys.stderr.write('I\'m a module.  Don\'t run me directly!')
+    sys.exit(-1)
@@ -0,0 +1,169 @@
+#!/usr/bin/python
+
+import sys
+import os
+import json
+import zipfile
+
+from lxml import etree
+
+import common
+
+from debug import debug, debugging, assert_d
+
+# A book's scandata, parsed once into plain records: a Page (with
+# __slots__) per <page> in pageData, in order, and a dict of leaf
+# number to Page.  scandata.xml and scandata.zip come out the same,
+# so callers read attributes rather than poking at objectify trees.
+#
+# The records are small enough to cache as json next to the item
+# (<book_id>_scandata.cache), so later runs don't re-parse the xml.
+
+cache_version = 1
+
+class Page(object):
+    __slots__ = ('leafNum', 'pageType', 'addToAccessFormats', 'handSide',
+                 'pageNumber')
+    def __init__(self, leafNum, pageType='', addToAccessFormats=False,
+                 handSide=None, pageNumber=None):
+        # int
+        self.leafNum = leafNum
+        # e.g. 'Normal', 'Title Page' - '' if not given
+        self.pageType = pageType
+        # bool
+        self.addToAccessFormats = addToAccessFormats
+        # 'LEFT', 'RIGHT' or None
+        self.handSide = handSide
+        # printed page number, as a string, or None if not asserted
+        self.pageNumber = pageNumber
+    def to_list(self):
+        return [self.leafNum, self.pageType, self.addToAccessFormats,
+                self.handSide, self.pageNumber]
+
+class Scandata(object):
+    def __init__(self, book_data, pages):
+        # text of the simple elements in bookData, by tag, e.g. 'dpi'
+        self.bookData = book_data
+        self.pages = pages
+        self.leaves = {}
+        for page in pages:
+            self.leaves[page.leafNum] = page
+
+    def get_dpi(self, default=300):
+        try:
+            return int(self.bookData['dpi'])
+        except (KeyError, TypeError, ValueError):
+            return default
+
+    def save(self, path, stamp):
+        cache = { 'version':cache_version,
+                  'source':stamp,
+                  'bookData':self.bookData,
+                  'pages':[page.to_list() for page in self.pages] }
+        common.write_atomically(path, lambda f: json.dump(cache, f))
+
+# local name of an element, or None for comments and PIs
+def nons(el):
+    if not isinstance(el.tag, basestring):
+        return None
+    return el.tag[el.tag.find('}') + 1:]
+
+def child_text(el, name):
+    for kid in el:
+        if nons(kid) == name:
+            return (kid.text or '').strip()
+    return None
+
+def parse(f):
+    root = etree.parse(f, etree.XMLParser(resolve_entities=False)).getroot()
+    book_data = {}
+    # leafNum -> pageNum, from bookData/pageNumData
+    assertions = {}
+    pages = []
+    for section in root:
+        name = nons(section)
+        if name == 'bookData':
+            for el in section:
+                tag = nons(el)
+                if tag == 'pageNumData':
+                    for assertion in el:
+                        leaf = child_text(assertion, 'leafNum')
+                        num = child_text(assertion, 'pageNum')
+                        if leaf and num:
+                            assertions[int(leaf)] = num
+                elif tag is not None and len(el) == 0:
+                    book_data[tag] = (el.text or '').strip()
+        elif name == 'pageData':
+            for el in section:
+                if nons(el) != 'page':
+                    continue
+                fields = {}
+                for kid in el:
+                    tag = nons(kid)
+                    if tag is not None and len(kid) == 0:
+                        fields[tag] = (kid.text or '').strip()
+                leaf = int(el.get('leafNum'))
+                pages.append(Page(leaf,
+                                  fields.get('pageType', ''),
+                                  fields.get('addToAccessFormats') == 'true',
+                                  fields.get('handSide') or None,
+                                  fields.get('pageNumber') or None))
+    for page in pages:
+        if page.pageNumber is None and page.leafNum in assertions:
+            page.pageNumber = assertions[page.leafNum]
+    return Scandata(book_data, pages)
+
+# as common.source_stamp, and which of the files scandata can come
+# from it was
+def source_stamp(source_path):
+    stamp = common.source_stamp(source_path)
+    stamp['path'] = os.path.basename(source_path)
+    return stamp
+
+def load(path, stamp):
+    try:
+        f = open(path, 'r')
+    except IOError:
+        return None
+    try:
+        cache = json.load(f)
+    except ValueError:
+        return None
+    finally:
+        f.close()
+    if cache.get('version') != cache_version or cache.get('source') != stamp:
+        return None
+    return Scandata(cache['bookData'], [Page(*p) for p in cache['pages']])
+
+def read_scandata(scandata_path):
+    (base, ext) = os.path.splitext(scandata_path)
+    if ext.lower() == '.zip':
+        z = zipfile.ZipFile(scandata_path, 'r')
+        f = z.open('scandata.xml')
+        try:
+            return parse(f)
+        finally:
+            f.close()
+            z.close()
+    return parse(scandata_path)
+
+# Scandata for an iarchive.Book - from the cache next to it if that's
+# up to date, otherwise parsed (and cached, if we can).
+def get_scandata(iabook, cache_path=None):
+    scandata_path = iabook.get_scandata_path()
+    if cache_path is None:
+        cache_path = os.path.join(iabook.get_book_path(),
+                                  iabook.get_book_id() + '_scandata.cache')
+    stamp = source_stamp(scandata_path)
+    scandata = load(cache_path, stamp)
+    if scandata is None:
+        scandata = read_scandata(scandata_path)
+        try:
+            scandata.save(cache_path, stamp)
+        except (IOError, OSError):
+            pass
+    return scandata
+
+if __name__ == '__main__':
+    sys.stderr.write('I\'m a module.  Don\'t run me directly!')
+    sys.exit(-1)
@@ -0,0 +1,192 @@
+#!/usr/bin/python
+
+import sys
+import os
+import time
+import resource
+import threading
+
+from debug import debug, debugging, assert_d
+
+# Where a conversion's time goes.  Stages of the converter are timed
+# with
+#
+#     with stats.timed('html'):
+#         ...
+#
+# which adds up calls, wall time and CPU time per stage name, and
+# epub.Book notes the size of every member it writes, by media-type.
+# Nothing is recorded (and timed() costs next to nothing) unless
+# collection has been started with reset().
+#
+# Stages used so far:
+#   parse    getting each page's text out of the ABBYY file (with
+#            text workers, this is time spent waiting on them)
+#   text     assembling paragraph text from a parsed page
+#   html     building and serialising xhtml (text chunks are
+#            serialised straight into the zip, so for them this
+#            includes compressing)
+#   image    reading and decoding page images (on prefetch threads)
+#   deflate  compressing epub members (perhaps on deflate threads)
+#   heads    finding running heads and feet (see running_heads.py)
+#   build_cache, image_cache
+#            keying and looking things up in the caches
+#
+# CPU time is per thread where the platform lets us measure it
+# (Linux), so work on image and deflate threads isn't counted against
+# whatever the main thread is doing meanwhile.
+
+enabled = False
+
+lock = threading.Lock()
+# stage name -> [calls, wall seconds, cpu seconds]
+stages = {}
+# media-type -> [count, bytes, bytes as stored in the zip]
+members = {}
+start_wall = None
+start_cpu = None
+
+# getrusage(RUSAGE_THREAD), which python 2's resource module doesn't
+# name
+RUSAGE_THREAD = 1
+
+if sys.platform.startswith('linux'):
+    def thread_cpu():
+        ru = resource.getrusage(RUSAGE_THREAD)
+        return ru.ru_utime + ru.ru_stime
+else:
+    def thread_cpu():
+        t = os.times()
+        return t[0] + t[1]
+
+def process_cpu():
+    t = os.times()
+    return t[0] + t[1]
+
+# start collecting, afresh
+def reset():
+    global enabled, start_wall, start_cpu
+    with lock:
+        stages.clear()
+        members.clear()
+        start_wall = time.time()
+        start_cpu = process_cpu()
+        enabled = True
+
+def stop():
+    global enabled
+    enabled = False
+
+def add_time(stage, wall, cpu, calls=1):
+    with lock:
+        s = stages.get(stage)
+        if s is None:
+            s = stages[stage] = [0, 0.0, 0.0]
+        s[0] += calls
+        s[1] += wall
+        s[2] += cpu
+
+class Timer(object):
+    __slots__ = ('stage', 'wall', 'cpu')
+    def __init__(self, stage):
+        self.stage = stage
+    def __enter__(self):
+        self.wall = time.time()
+        self.cpu = thread_cpu()
+        return self
+    def __exit__(self, exc_type, exc_value, tb):
+        add_time(self.stage, time.time() - self.wall,
+                 thread_cpu() - self.cpu)
+        return False
+
+class NullTimer(object):
+    def __enter__(self):
+        return self
+    def __exit__(self, exc_type, exc_value, tb):
+        return False
+
+null_timer = NullTimer()
+
+def timed(stage):
+    if not enabled:
+        return null_timer
+    return Timer(stage)
+
+# times each step of an iterator against stage
+def timed_iter(stage, iterable):
+    if not enabled:
+        return iterable
+    return timed_iter_gen(stage, iterable)
+
+def timed_iter_gen(stage, iterable):
+    it = iter(iterable)
+    while True:
+        wall = time.time()
+        cpu = thread_cpu()
+        try:
+            item = it.next()
+        except StopIteration:
+            return
+        add_time(stage, time.time() - wall, thread_cpu() - cpu)
+        yield item
+
+def count_member(media_type, size, stored_size):
+    if not enabled:
+        return
+    if media_type is None:
+        media_type = 'other'
+    with lock:
+        m = members.get(media_type)
+        if m is None:
+            m = members[media_type] = [0, 0, 0]
+        m[0] += 1
+        m[1] += size
+        m[2] += stored_size
+
+def peak_rss_kb(who=resource.RUSAGE_SELF):
+    rss = resource.getrusage(who).ru_maxrss
+    if sys.platform == 'darwin':
+        # bytes, not KB
+        rss /= 1024
+    return rss
+
+# what's been collected, as a dict that json.dump can take
+def report():
+    with lock:
+        result = {
+            'wall':(time.time() - start_wall if start_wall is not None
+                    else 0.0),
+            'cpu':(process_cpu() - start_cpu if start_cpu is not None
+                   else 0.0),
+            'peak_rss_kb':peak_rss_kb(),
+            # largest of any child process: text workers, image tools
+            'children_peak_rss_kb':peak_rss_kb(resource.RUSAGE_CHILDREN),
+            'stages':{},
+            'members':{},
+            }
+        for name, (calls, wall, cpu) in stages.items():
+            result['stages'][name] = { 'calls':calls, 'wall':wall, 'cpu':cpu }
+        for media_type, (count, size, stored) in members.items():
+            result['members'][media_type] = { 'count':count, 'bytes':size,
+                                              'stored_bytes':stored }
+    return result
+
+def write_report(r, out):
+    out.write('%-12s %8s %10s %10s\n' % ('stage', 'calls', 'wall', 'cpu'))
+    for name in sorted(r['stages'].keys()):
+        s = r['stages'][name]
+        out.write('%-12s %8d %10.3f %10.3f\n'
+                  % (name, s['calls'], s['wall'], s['cpu']))
+    out.write('%-12s %8s %10.3f %10.3f\n' % ('total', '', r['wall'], r['cpu']))
+    out.write('\n%-32s %6s %12s %12s\n' % ('media-type', 'count', 'bytes',
+                                           'stored'))
+    for media_type in sorted(r['members'].keys()):
+        m = r['members'][media_type]
+        out.write('%-32s %6d %12d %12d\n' % (media_type, m['count'],
+                                             m['bytes'], m['stored_bytes']))
+    out.write('\npeak rss %d KB (children %d KB)\n'
+              % (r['peak_rss_kb'], r['children_peak_rss_kb']))
+
+if __name__ == '__main__':
+    sys.stderr.write('I\'m a module.  Don\'t run me directly!')
+    sys.exit(-1)
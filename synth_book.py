@@ -0,0 +1,321 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import sys
+import getopt
+import os
+import gzip
+import random
+import struct
+import zipfile
+import StringIO
+
+from xml.sax.saxutils import escape, quoteattr
+
+from debug import debug, debugging, assert_d
+
+# Generates a synthetic Internet Archive book item - FineReader6-schema
+# abbyy.gz, _scandata.xml, _meta.xml and a stub page image zip - for
+# benchmarking and for exercising the converter without real items.
+
+aby_ns = 'http://www.abbyy.com/FineReader_xml/FineReader6-schema-v1.xml'
+
+words = ('the of and to in that was his he it with is for as had you not be '
+         'her on at by which have or from this him but all she they were my '
+         'are me one their so an said them we who would been will no when '
+         'there if more out up into do any your what has man could other '
+         'than our some very time upon about may its only now like little '
+         'then can should made did us such great before must two these see '
+         'know over much down after first mister good men own never most '
+         'old shall day where those came come himself way work life without '
+         'go make well through being long say might how am too even def '
+         'under new same last just many again house thought nothing '
+         'remarkable considerable extraordinary circumstances '
+         'notwithstanding conversation particularly').split()
+
+roman = ['i', 'ii', 'iii', 'iv', 'v', 'vi', 'vii', 'viii', 'ix', 'x',
+         'xi', 'xii', 'xiii', 'xiv', 'xv', 'xvi', 'xvii', 'xviii', 'xix', 'xx']
+
+def usage():
+    sys.stderr.write("\n")
+    sys.stderr.write("Usage: synth_book.py [options] book_id\n")
+    sys.stderr.write("  Writes a synthetic book item to outdir/book_id/.\n")
+    sys.stderr.write("\n")
+    sys.stderr.write("  -p, --pages=N       number of leaves (default 40)\n")
+    sys.stderr.write("  -w, --words=N       words per text page (default 300)\n")
+    sys.stderr.write("  -o, --outdir=DIR    output directory (default .)\n")
+    sys.stderr.write("  -s, --seed=N        random seed (default 0)\n")
+    sys.stderr.write("  --jp2               write _jp2.zip (needs Pillow with\n")
+    sys.stderr.write("                      OpenJPEG) instead of _tif.zip\n")
+
+def main(argv):
+    try:
+        opts, args = getopt.getopt(argv, "hp:w:o:s:",
+                                   ["help", "pages=", "words=", "outdir=",
+                                    "seed=", "jp2"])
+    except getopt.GetoptError:
+        usage()
+        sys.exit(-1)
+    pages = 40
+    words_per_page = 300
+    outdir = '.'
+    seed = 0
+    image_type = 'tif'
+    for opt, arg in opts:
+        if opt in ('-h', '--help'):
+            usage()
+            sys.exit()
+        elif opt in ('-p', '--pages'):
+            pages = int(arg)
+        elif opt in ('-w', '--words'):
+            words_per_page = int(arg)
+        elif opt in ('-o', '--outdir'):
+            outdir = arg
+        elif opt in ('-s', '--seed'):
+            seed = int(arg)
+        elif opt == '--jp2':
+            image_type = 'jp2'
+    if len(args) != 1:
+        usage()
+        sys.exit(-1)
+    book_path = make_book(args[0], outdir, pages, words_per_page,
+                          seed, image_type)
+    print book_path
+
+def make_book(book_id, outdir='.', pages=40, words_per_page=300,
+              seed=0, image_type='tif', page_width=2500, page_height=3300):
+    book_path = os.path.join(outdir, book_id)
+    if not os.path.isdir(book_path):
+        os.makedirs(book_path)
+    leaves = make_leaves(pages)
+    rand = random.Random(seed)
+
+    aby = gzip.open(os.path.join(book_path, book_id + '_abbyy.gz'), 'wb')
+    write_abbyy(aby, leaves, rand, words_per_page, page_width, page_height)
+    aby.close()
+
+    f = open(os.path.join(book_path, book_id + '_scandata.xml'), 'w')
+    f.write(make_scandata(book_id, leaves))
+    f.close()
+
+    f = open(os.path.join(book_path, book_id + '_meta.xml'), 'w')
+    f.write(make_meta(book_id))
+    f.close()
+
+    write_image_zip(book_path, book_id, leaves, image_type,
+                    page_width / 10, page_height / 10)
+    return book_path
+
+def make_leaves(pages):
+    # (pageType, addToAccessFormats, page number or None) for each leaf:
+    # a cover, a couple of pre-title pages, title, copyright and
+    # contents, numbered text pages with a colour card that should not
+    # be included, and a back cover.
+    leaves = [('Cover', True, None),
+              ('Normal', True, None),
+              ('Normal', True, None),
+              ('Title', True, None),
+              ('Copyright', True, None),
+              ('Contents', True, None)]
+    number = 1
+    while len(leaves) < pages - 1:
+        if len(leaves) == pages / 2:
+            leaves.append(('Color Card', False, None))
+        else:
+            leaves.append(('Normal', True, number))
+            number += 1
+    leaves.append(('Cover', True, None))
+    return leaves[:max(pages, 1)]
+
+def make_scandata(book_id, leaves):
+    out = ['<?xml version="1.0" encoding="UTF-8"?>\n', '<book>\n',
+           '  <bookData>\n',
+           '    <bookId>' + escape(book_id) + '</bookId>\n',
+           '    <leafCount>' + str(len(leaves)) + '</leafCount>\n',
+           '    <dpi>300</dpi>\n',
+           '  </bookData>\n',
+           '  <pageData>\n']
+    for leaf, (page_type, access, number) in enumerate(leaves):
+        out.append('    <page leafNum="' + str(leaf) + '">\n')
+        out.append('      <pageType>' + page_type + '</pageType>\n')
+        out.append('      <addToAccessFormats>'
+                   + ('true' if access else 'false')
+                   + '</addToAccessFormats>\n')
+        out.append('      <handSide>'
+                   + ('RIGHT' if leaf % 2 == 0 else 'LEFT')
+                   + '</handSide>\n')
+        if number is not None:
+            out.append('      <pageNumber>' + str(number) + '</pageNumber>\n')
+        out.append('    </page>\n')
+    out.append('  </pageData>\n</book>\n')
+    return ''.join(out)
+
+def make_meta(book_id):
+    return ('<?xml version="1.0" encoding="UTF-8"?>\n'
+            '<metadata>\n'
+            '  <identifier>' + escape(book_id) + '</identifier>\n'
+            '  <title>Synthetic book ' + escape(book_id) + '</title>\n'
+            '  <creator>Nobody, A.</creator>\n'
+            '  <publisher>Nowhere Press</publisher>\n'
+            '  <date>1900</date>\n'
+            '  <language>eng</language>\n'
+            '  <mediatype>texts</mediatype>\n'
+            '</metadata>\n')
+
+def write_abbyy(out, leaves, rand, words_per_page, page_width, page_height):
+    out.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+    out.write('<document xmlns="' + aby_ns + '" version="1.0" '
+              'producer="synth_book" pagesCount="' + str(len(leaves)) + '">\n')
+    for page_type, access, number in leaves:
+        out.write('<page width="' + str(page_width) + '" height="'
+                  + str(page_height) + '" resolution="300" '
+                  'originalCoords="true">\n')
+        if page_type == 'Normal' and number is not None:
+            write_text_page(out, rand, number, words_per_page,
+                            page_width, page_height)
+        elif page_type != 'Color Card':
+            write_block(out, rand, [[page_type.upper()]], 300, 400,
+                        page_width - 300)
+        out.write('</page>\n')
+    out.write('</document>\n')
+
+def write_text_page(out, rand, number, words_per_page,
+                    page_width, page_height):
+    left = 250
+    right = page_width - 250
+    # running head: folio and title, alternating sides
+    folio = roman[number - 1] if number <= len(roman) / 2 else str(number)
+    if number % 2:
+        head = [['SYNTHETIC', 'BOOK', folio]]
+    else:
+        head = [[folio]]
+    write_block(out, rand, head, 150, left, right)
+    pars = []
+    remaining = words_per_page
+    while remaining > 0:
+        n = min(remaining, rand.randint(20, 120))
+        par = [rand.choice(words) for j in range(n)]
+        par[0] = par[0].capitalize()
+        par[-1] += '.'
+        pars.append(par)
+        remaining -= n
+    write_block(out, rand, [pars_to_lines(par) for par in pars], 300,
+                left, right)
+
+def pars_to_lines(par, line_chars=60):
+    # break a paragraph into lines, sometimes hyphenating the last word
+    lines = []
+    line = []
+    length = 0
+    for word in par:
+        if length + len(word) > line_chars and line:
+            if len(word) > 8:
+                cut = len(word) / 2
+                line.append(word[:cut] + '-')
+                lines.append(line)
+                line = [(word[cut:], False)]
+                length = len(word) - cut
+                continue
+            lines.append(line)
+            line = []
+            length = 0
+        line.append(word)
+        length += len(word) + 1
+    if line:
+        lines.append(line)
+    return lines
+
+def write_block(out, rand, pars, top, left, right):
+    # pars is a list of paragraphs; a paragraph is a list of lines or
+    # (for one-line paragraphs) a list of words.
+    line_height = 50
+    char_width = (right - left) / 64
+    n_lines = sum([len(par) if isinstance(par[0], list) else 1
+                   for par in pars])
+    bottom = top + n_lines * line_height
+    out.write('<block blockType="Text" l="%d" t="%d" r="%d" b="%d">'
+              '<region><rect l="%d" t="%d" r="%d" b="%d"/></region>\n'
+              % (left, top, right, bottom, left, top, right, bottom))
+    out.write('<text>\n')
+    y = top
+    for par in pars:
+        lines = par if isinstance(par[0], list) else [par]
+        out.write('<par align="Justified" leftIndent="0" rightIndent="0" '
+                  'startIndent="300" lineSpacing="%d">\n' % line_height)
+        for line in lines:
+            x = left
+            out.write('<line baseline="%d" l="%d" t="%d" r="%d" b="%d">'
+                      % (y + 40, left, y, right, y + line_height - 5))
+            out.write('<formatting lang="English" ff="Times New Roman" '
+                      'fs="10.">')
+            first = True
+            for word in line:
+                word_start = True
+                if isinstance(word, tuple):
+                    word, word_start = word
+                if not first:
+                    x = write_char(out, ' ', x, y, char_width, True, False)
+                numeric = word.isdigit() or word in roman
+                for j, ch in enumerate(word):
+                    x = write_char(out, ch, x, y, char_width,
+                                   word_start and j == 0, numeric,
+                                   rand.random() < 0.01)
+                first = False
+            out.write('</formatting></line>\n')
+            y += line_height
+        out.write('</par>\n')
+    out.write('</text>\n</block>\n')
+
+def write_char(out, ch, x, y, width, word_start, numeric, suspicious=False):
+    atts = ('l="%d" t="%d" r="%d" b="%d" wordStart="%s" '
+            'wordFromDictionary="true" wordNormal="true" '
+            'wordNumeric="%s" wordIdentifier="false" charConfidence="90"'
+            % (x, y, x + width - 2, y + 40,
+               'true' if word_start else 'false',
+               'true' if numeric else 'false'))
+    if suspicious:
+        atts += ' suspicious="true"'
+    out.write('<charParams ' + atts + '>' + escape(ch) + '</charParams>')
+    return x + width
+
+def write_image_zip(book_path, book_id, leaves, image_type, width, height):
+    if image_type == 'jp2':
+        from PIL import Image
+    zipf = os.path.join(book_path, book_id + '_' + image_type + '.zip')
+    z = zipfile.ZipFile(zipf, 'w')
+    for leaf in range(len(leaves)):
+        name = (book_id + '_' + image_type + '/' + book_id + '_'
+                + str(leaf).zfill(4) + '.' + image_type)
+        shade = 255 - (leaf * 7) % 64
+        if image_type == 'jp2':
+            buf = StringIO.StringIO()
+            Image.new('L', (width, height), shade).save(buf, 'JPEG2000')
+            data = buf.getvalue()
+        else:
+            data = make_tiff(width, height, shade)
+        z.writestr(zipfile.ZipInfo(name), data)
+    z.close()
+
+def make_tiff(width, height, shade):
+    # minimal uncompressed 8-bit greyscale baseline tiff
+    pixels = chr(shade) * (width * height)
+    entries = [(256, 4, 1, width),          # ImageWidth
+               (257, 4, 1, height),         # ImageLength
+               (258, 3, 1, 8),              # BitsPerSample
+               (259, 3, 1, 1),              # Compression: none
+               (262, 3, 1, 1),              # Photometric: black is zero
+               (273, 4, 1, 8),              # StripOffsets
+               (277, 3, 1, 1),              # SamplesPerPixel
+               (278, 4, 1, height),         # RowsPerStrip
+               (279, 4, 1, len(pixels))]    # StripByteCounts
+    ifd = struct.pack('<H', len(entries))
+    for tag, typ, count, value in entries:
+        if typ == 3:
+            ifd += struct.pack('<HHIHH', tag, typ, count, value, 0)
+        else:
+            ifd += struct.pack('<HHII', tag, typ, count, value)
+    ifd += struct.pack('<I', 0)
+    return struct.pack('<2sHI', 'II', 42, 8 + len(pixels)) + pixels + ifd
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,150 @@
+#!/usr/bin/python
+
+import sys
+import os
+import tempfile
+import threading
+import subprocess
+import multiprocessing
+
+from debug import debug, debugging, assert_d
+
+# Runs pipelines of external tools (kdu_expand, the netpbm programs),
+# each given as an argument list rather than a shell string:
+#
+#     output = tool_runner.run_pipeline([['tifftopnm', '-quiet', path],
+#                                        ['pnmscale', ...]])
+#
+# A pipeline that runs for longer than its timeout is killed, and a
+# tool that exits with an error makes run_pipeline raise an Exception,
+# with what the tool said on stderr, rather than quietly giving back
+# a truncated or empty image.
+#
+# No more than limits[tool] copies of a tool run at once, across all
+# threads; a pipeline waits until it can have every tool it needs.
+
+# seconds a pipeline may run for
+default_timeout = 300
+
+# per-tool limits on copies running at once; tools not listed get
+# default_limit
+limits = { 'kdu_expand':max(1, multiprocessing.cpu_count() / 2) }
+default_limit = multiprocessing.cpu_count()
+
+semaphores = {}
+semaphores_lock = threading.Lock()
+
+def set_limit(tool, n):
+    with semaphores_lock:
+        limits[tool] = n
+        semaphores.pop(tool, None)
+
+def get_semaphore(tool):
+    with semaphores_lock:
+        sem = semaphores.get(tool)
+        if sem is None:
+            sem = semaphores[tool] = threading.BoundedSemaphore(
+                limits.get(tool, default_limit))
+        return sem
+
+# Run the commands in cmds (lists of arguments) as a pipeline, feeding
+# input_data to the first and returning what the last writes.
+def run_pipeline(cmds, input_data='', timeout=None):
+    if timeout is None:
+        timeout = default_timeout
+    # always take the semaphores in the same order, so two pipelines
+    # can't each hold one the other's waiting for
+    tools = sorted(set([os.path.basename(cmd[0]) for cmd in cmds]))
+    sems = [get_semaphore(tool) for tool in tools]
+    for sem in sems:
+        sem.acquire()
+    try:
+        return run_pipeline_now(cmds, input_data, timeout)
+    finally:
+        for sem in reversed(sems):
+            sem.release()
+
+def run_pipeline_now(cmds, input_data, timeout):
+    errors = tempfile.TemporaryFile()
+    procs = []
+    try:
+        try:
+            for j, cmd in enumerate(cmds):
+                if j == 0:
+                    stdin = subprocess.PIPE
+                else:
+                    stdin = procs[-1].stdout
+                procs.append(subprocess.Popen(cmd, stdin=stdin,
+                                              stdout=subprocess.PIPE,
+                                              stderr=errors,
+                                              close_fds=True))
+                if j > 0:
+                    # the next tool has it; if it dies, this one should
+                    # see SIGPIPE rather than block
+                    procs[-2].stdout.close()
+        except OSError, e:
+            kill(procs)
+            raise Exception('can\'t run ' + cmds[len(procs)][0] + ': '
+                            + str(e))
+        timed_out = []
+        def on_timeout():
+            timed_out.append(True)
+            kill(procs)
+        timer = threading.Timer(timeout, on_timeout)
+        timer.start()
+        try:
+            writer = threading.Thread(target=feed, args=(procs[0].stdin,
+                                                         input_data))
+            writer.daemon = True
+            writer.start()
+            output = procs[-1].stdout.read()
+            procs[-1].stdout.close()
+            writer.join()
+            for p in procs:
+                p.wait()
+        finally:
+            timer.cancel()
+            timer.join()
+        if timed_out:
+            raise Exception('timed out after ' + str(timeout) + 's: '
+                            + describe(cmds))
+        # one tool failing often takes the others with it, so name
+        # them all
+        failed = [cmd[0] + ' (' + str(p.returncode) + ')'
+                  for cmd, p in zip(cmds, procs) if p.returncode != 0]
+        if failed:
+            errors.seek(0)
+            raise Exception('failed: ' + ', '.join(failed) + ' in '
+                            + describe(cmds) + ': '
+                            + errors.read(4096).strip())
+        return output
+    except:
+        kill(procs)
+        raise
+    finally:
+        errors.close()
+
+def feed(f, data):
+    try:
+        f.write(data)
+        f.close()
+    except IOError:
+        # the tool's gone - it's been killed, or didn't want it all
+        pass
+
+def kill(procs):
+    for p in procs:
+        if p.poll() is None:
+            try:
+                p.kill()
+            except OSError:
+                pass
+    for p in procs:
+        p.wait()
+
+def describe(cmds):
+    return ' | '.join([' '.join(cmd) for cmd in cmds])
+
+if __name__ == '__main__':
+    sys.stderr.write('I\'m a module.  Don\'t run me directly!')
+    sys.exit(-1)
@@ -2,11 +2,8 @@
 
 import sys
 import getopt
-import re
 import os
 
-from lxml import etree
-from lxml import objectify
 
 import iarchive
 import common
@@ -17,86 +14,63 @@ kdu_reduce = 2
 scale = 2 ** kdu_reduce
 s = scale
 
-from debug import debug, debugging, assert_d
+from debug import debug, debugging, assert_d, profiled
 
 def usage():
-    print 'usage: visualize_abbyy.py'
+    print 'usage: visualize_abbyy.py [--image-cache=DIR] [page index ...]'
+    print '  Renders every page, or just the pages given.'
+    print '  --image-cache=DIR keeps scaled page images in DIR for reuse.'
 
 def main(argv):
     if not os.path.isdir('./' + outdir+ '/'):
         os.mkdir('./' + outdir + '/')
 
+    try:
+        opts, args = getopt.getopt(argv, 'h', ['help', 'image-cache='])
+        pages = [int(arg) for arg in args]
+    except (getopt.GetoptError, ValueError):
+        usage()
+        sys.exit(-1)
+    image_cache = None
+    for opt, arg in opts:
+        if opt in ('-h', '--help'):
+            usage()
+            sys.exit()
+        elif opt == '--image-cache':
+            image_cache = iarchive.get_image_cache(arg)
+
     id = common.get_book_id()
-    iabook = iarchive.Book(id, '.')
-    visualize(iabook)
+    iabook = iarchive.Book(id, '.', image_cache=image_cache)
+    visualize(iabook, pages if len(pages) > 0 else None)
+    iabook.close()
 
-abbyyns="{http://www.abbyy.com/FineReader_xml/FineReader6-schema-v1.xml}"
-abyns = abbyyns
 import Image
 import ImageDraw
 import ImageFont 
 import color
 from color import color as c
-def visualize(iabook):
+from abbyy_columns import block_types
+# pages - list of page indices to render, or None for all of them
+def visualize(iabook, pages=None):
 #    scandata = objectify.parse(iabook.get_scandata_path()).getroot()
     scandata = iabook.get_scandata()
-    context = etree.iterparse(iabook.get_abbyy(), tag=abbyyns+'page')
-    info = scan_pages(context, scandata, iabook)
-
-def draw_rect(draw, el, sty, use_coords=None):
+    # the geometry comes from the columnar form of the ABBYY file,
+    # which is cached, so there's no re-parsing the xml each time
+    cols = iabook.get_abbyy_columns()
+    if pages is None:
+        pages = range(cols.n_pages)
+    info = scan_pages(pages, cols, scandata, iabook)
+
+# box is l, t, r, b in page coordinates
+def draw_rect(draw, box, sty):
     if sty['width'] == 0:
         return
-    
-    lt, rb = use_coords if use_coords is not None else tag_coords(el, s)
-
-    x1, y1 = lt
-    x2, y2 = rb
-
-    enclosing = None
-    if use_coords is None:
-        enclosing = enclosing_tag(el)
-    if enclosing is not None and enclosing.get('t') is not None:
-        elt, erb = tag_coords(enclosing, s)
-        ex1, ey1 = elt
-        ex2, ey2 = erb
-
-        margin = sty['margin']
-
-        near = 3
-
-        x1 = x1 + margin if x1 - ex1 < near else x1
-        x2 = x2 - margin if ex2 - x2 < near else x2
-        y1 = y1 + margin if y1 - ey1 < near else y1
-        y2 = y2 - margin if ey2 - y2 < near else y2
-
-#     x1 += sty['offset']
-#     y1 += sty['offset']
-#     x2 += sty['offset']
-#     y2 += sty['offset']
+    x1, y1, x2, y2 = scale_box(box)
     draw.line([(x1, y1), (x2, y1), (x2, y2), (x1, y2), (x1, y1)],
               width=sty['width'], fill=sty['col'])
-    
-def tag_coords(tag, s):
-    t = int(tag.get('t'))/s
-    b = int(tag.get('b'))/s
-    l = int(tag.get('l'))/s
-    r = int(tag.get('r'))/s
-    return ((l, t), (r, b))
 
-def four_coords(tag, s):
-    l = int(tag.get('l'))/s
-    t = int(tag.get('t'))/s
-    r = int(tag.get('r'))/s
-    b = int(tag.get('b'))/s
-    return l, t, r, b
-
-def enclosing_tag(tag):
-    tag_with_coords = tag
-    while tag_with_coords is not None:
-        tag_with_coords = tag.getparent()
-        if tag_with_coords is not None and tag.get('t') is not None:
-            break
-    return tag_with_coords
+def scale_box(box):
+    return tuple([int(coord) / s for coord in box])
 
 styles = {
     'block_text' : { 'col':color.yellow, 'width':1, 'offset':0, 'margin':10 },
@@ -107,52 +81,32 @@ styles = {
     'line' : { 'col':color.blue, 'width':1, 'offset':0, 'margin':10 },
     }
 
-def nons(tag):
-    return re.sub('{.*}', '', tag)
-
-def render(draw, el, expected, use_coords=None):
-    assert_tag(el, expected)
-    sty = styles[expected]
-    draw_rect(draw, el, sty, use_coords)
+block_styles = { 'Text':'block_text',
+                 'Picture':'block_picture',
+                 'Table':'block_table' }
 
-def assert_tag(el, expected):
-    shorttag = nons(el.tag)
-    if (shorttag != 'block'):
-        assert_d(shorttag == expected)
-
-def box_from_par(par):
-    if len(par) > 0:
-        (o_l, o_t), (o_r, o_b) = tag_coords(par[0], s)
-        for line in par:
-            (l, t), (r, b) = tag_coords(line, s)
-            o_l = l if (l - o_l < 0) else o_l
-            o_t = t if (t - o_t < 0) else o_t
-            o_r = r if (o_r - r < 0) else o_r
-            o_b = b if (o_b - b < 0) else o_b
-        return (o_l, o_t), (o_r, o_b)
-    else:
+# the box around a paragraph's lines
+def par_box(cols, k):
+    boxes = cols.line_box[cols.par_line[k]:cols.par_line[k + 1]]
+    if len(boxes) == 0:
         return None
+    return (boxes[:, 0].min(), boxes[:, 1].min(),
+            boxes[:, 2].max(), boxes[:, 3].max())
 
 import os
 
 import StringIO
-import font
-def scan_pages(context, scandata, iabook):
+@profiled
+def scan_pages(pages, cols, scandata, iabook):
     book_id = iabook.get_book_id()
-    scandata_pages = scandata.pageData.page
-    try:
-        # dpi isn't always there
-        dpi = int(scandata.bookData.dpi.text)
-    except AttributeError:
-        dpi = 300
-    i = 0
+    scandata_pages = scandata.pages
+    # the columns don't keep the ABBYY formatting (font, size), so the
+    # text is all drawn in the default font
     f = ImageFont.load_default()
-#    f = ImageFont.load('/Users/mccabe/s/archive/epub/Times-18.bdf')
-    for event, page in context:
-        orig_width = int(page.get('width'))
-        orig_height = int(page.get('height'))
-        width = orig_width / s
-        height = orig_height / s
+    for i in pages:
+        orig_width, orig_height = cols.page_size[i]
+        width = int(orig_width) / s
+        height = int(orig_height) / s
         
         image = Image.new('RGB', (width, height))
 
@@ -174,95 +128,47 @@ def scan_pages(context, scandata, iabook):
                 
         draw = ImageDraw.Draw(image)
 
-        for block in page:
-            if block.get('blockType') == 'Picture' and page_image is not None:
-                cropped = page_image.crop(four_coords(block, scale))
-                image.paste(cropped, four_coords(block, scale))
+        blocks = xrange(cols.page_block[i], cols.page_block[i + 1])
+        for j in blocks:
+            if (block_types[cols.block_type[j]] == 'Picture'
+                and page_image is not None):
+                box = scale_box(cols.block_box[j])
+                cropped = page_image.crop(box)
+                image.paste(cropped, box)
                 
-        for block in page:
-            if block.get('blockType') == 'Text':
-                render(draw, block, 'block_text')    
-            if block.get('blockType') == 'Picture':
-                render(draw, block, 'block_picture')
-            if block.get('blockType') == 'Table':
-                render(draw, block, 'block_table')
-#             else:
-#                 render(draw, block, 'block_picture')
-#                 if i > 0:
-#                     cropped = page_image.crop(four_coords(block))
-#                     image.paste(cropped, four_coords(block))
-            for el in block:
-                if el.tag == abyns+'region':
-                    pass
-                elif el.tag == abyns+'row':
-                    for cell in el:
-                        for text in cell:
-                            for par in text:
-                                par_coords = box_from_par(par)
-                                if par_coords is not None:
-                                    render(draw, par, 'par', par_coords)
-                                for line in par:
-                                    render(draw, line, 'line');
-                                    for fmt in line:
-                                        assert_d(fmt.tag == abyns+'formatting')
-                                        font_name = fmt.get('ff')
-                                        font_size = fmt.get('fs')
-                                        font_size = int(re.sub('\.', '', font_size))
-                                        font_ital = (fmt.get('italic') == 'true')
-                                        f = font.get_font(font_name, dpi / scale, font_size, font_ital)
-                                        for cp in fmt:
-                                            assert_d(cp.tag == abyns+'charParams')
-                                            draw.text((int(cp.get('l'))/s,
-                                                       int(cp.get('b'))/s),
-                                                      cp.text.encode('utf-8'),
-                                                      font=f,
-                                                      fill=color.yellow)
-                elif el.tag == abyns+'text':
-                    for par in el:
-                        par_coords = box_from_par(par)
-                        if par_coords is not None:
-                            render(draw, par, 'par', par_coords)
-                        for line in par:
-                            render(draw, line, 'line');
-                            for fmt in line:
-                                assert_d(fmt.tag == abyns+'formatting')
-                                font_name = fmt.get('ff')
-                                font_size = fmt.get('fs')
-                                font_size = int(re.sub('\.', '', font_size))
-                                font_ital = (fmt.get('italic') == 'true')
-                                f = font.get_font(font_name, dpi / scale, font_size, font_ital)
-                                for cp in fmt:
-                                    assert_d(cp.tag == abyns+'charParams')
-                                    draw.text((int(cp.get('l'))/s,
-                                               int(cp.get('b'))/s),
-                                              cp.text.encode('utf-8'),
-                                              font=f,
-                                              fill=color.yellow)
-                elif (el.tag == abyns+'row'):
-                    pass
-                else:
-                    print('unexpected tag type' + el.tag)
-                    sys.exit(-1)
+        for j in blocks:
+            style = block_styles.get(block_types[cols.block_type[j]])
+            if style is not None:
+                draw_rect(draw, cols.block_box[j], styles[style])
+            # paragraphs in table cells are among the block's too
+            for k in xrange(cols.block_par[j], cols.block_par[j + 1]):
+                box = par_box(cols, k)
+                if box is not None:
+                    draw_rect(draw, box, styles['par'])
+                for line in xrange(cols.par_line[k], cols.par_line[k + 1]):
+                    draw_rect(draw, cols.line_box[line], styles['line'])
+                    for ch in xrange(cols.line_char[line],
+                                     cols.line_char[line + 1]):
+                        code = cols.chars[ch]
+                        if code == 0:
+                            continue
+                        l, t, r, b = cols.char_box[ch]
+                        draw.text((int(l) / s, int(b) / s),
+                                  unichr(code).encode('utf-8'),
+                                  font=f,
+                                  fill=color.yellow)
 
         if not include_page(scandata_pages[i]):
             draw.line([(0, 0), image.size], width=50, fill=color.red)
         
-        image.save(outdir + '/img' + scandata_pages[i].get('leafNum') + '.png')
+        image.save(outdir + '/img' + str(scandata_pages[i].leafNum) + '.png')
         print 'page index: ' + str(i)
-        page.clear()
-        i += 1
     return None
 
 def include_page(page):
     if page is None:
         return False
-    add = page.find('addToAccessFormats')
-    if add is None:
-        add = page.addToAccessFormats
-    if add is not None and add.text == 'true':
-        return True
-    else:
-        return False
+    return page.addToAccessFormats
 
 
 
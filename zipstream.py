@@ -0,0 +1,189 @@
+#!/usr/bin/python
+
+import sys
+import os
+import struct
+import zlib
+import zipfile
+
+from debug import debug, debugging, assert_d
+
+# A zip writer that never seeks or tells, so it can write to stdout,
+# a pipe or a socket as well as to a regular file.
+#
+# Members whose content is already in hand are written with their
+# sizes and crc in the local header.  Members opened with open() are
+# streamed: the local header has the 'data descriptor' flag set, and
+# the crc and sizes follow the data.  The central directory is written
+# from what we've recorded along the way.
+
+class ZipWriter(object):
+    def __init__(self, out):
+        # out is a filename or a writable file object
+        if isinstance(out, basestring):
+            # don't write through a hard link into another copy of the
+            # file (e.g. one in a build cache)
+            if os.path.isfile(out) and os.stat(out).st_nlink > 1:
+                os.remove(out)
+            self.fp = open(out, 'wb')
+            self.own_fp = True
+        else:
+            self.fp = out
+            self.own_fp = False
+        self.offset = 0
+        self.infos = []
+        self.open_member = None
+
+    def write_raw(self, data):
+        self.fp.write(data)
+        self.offset += len(data)
+
+    def writestr(self, zinfo, data, level=zlib.Z_DEFAULT_COMPRESSION):
+        if zinfo.compress_type == zipfile.ZIP_DEFLATED:
+            co = zlib.compressobj(level, zlib.DEFLATED, -15)
+            compressed = co.compress(data) + co.flush()
+        elif zinfo.compress_type == zipfile.ZIP_STORED:
+            compressed = data
+        else:
+            raise Exception('unsupported compression type')
+        self.write_compressed(zinfo, compressed,
+                              zlib.crc32(data) & 0xffffffff, len(data))
+
+    # write a member that has already been compressed
+    # (according to zinfo.compress_type)
+    def write_compressed(self, zinfo, compressed, crc, file_size):
+        if self.open_member is not None:
+            raise Exception('can\'t write while a member is open')
+        zinfo.flag_bits &= ~0x08
+        zinfo.CRC = crc
+        zinfo.compress_size = len(compressed)
+        zinfo.file_size = file_size
+        zinfo.header_offset = self.offset
+        self.write_raw(zinfo.FileHeader())
+        self.write_raw(compressed)
+        self.infos.append(zinfo)
+
+    # returns a file-like object to write the member's content to;
+    # close it before writing anything else.  If compress is False,
+    # the content is compressed by the caller and given to the
+    # object's write_compressed.
+    def open(self, zinfo, level=zlib.Z_DEFAULT_COMPRESSION, compress=True):
+        if self.open_member is not None:
+            raise Exception('can\'t open two members at once')
+        self.open_member = ZipMemberWriter(self, zinfo, level, compress)
+        return self.open_member
+
+    def close(self):
+        if self.fp is None:
+            return
+        if self.open_member is not None:
+            self.open_member.close()
+        cd_offset = self.offset
+        for zinfo in self.infos:
+            self.write_raw(central_dir_entry(zinfo))
+        cd_size = self.offset - cd_offset
+        if (cd_offset > 0xffffffff or len(self.infos) > 0xffff):
+            raise Exception('zip too big - zip64 not supported')
+        self.write_raw(struct.pack(zipfile.structEndArchive,
+                                   zipfile.stringEndArchive,
+                                   0, 0, len(self.infos), len(self.infos),
+                                   cd_size, cd_offset, 0))
+        self.fp.flush()
+        if self.own_fp:
+            self.fp.close()
+        self.fp = None
+
+    # give up on the zip, leaving it without a central directory
+    def abort(self):
+        if self.fp is None:
+            return
+        self.open_member = None
+        if self.own_fp:
+            self.fp.close()
+        self.fp = None
+
+class ZipMemberWriter(object):
+    def __init__(self, zw, zinfo, level, compress=True):
+        self.zw = zw
+        self.zinfo = zinfo
+        if zinfo.compress_type not in (zipfile.ZIP_DEFLATED,
+                                       zipfile.ZIP_STORED):
+            raise Exception('unsupported compression type')
+        if compress and zinfo.compress_type == zipfile.ZIP_DEFLATED:
+            self.co = zlib.compressobj(level, zlib.DEFLATED, -15)
+        else:
+            self.co = None
+        zinfo.flag_bits |= 0x08
+        zinfo.header_offset = zw.offset
+        zinfo.CRC = 0
+        zinfo.compress_size = 0
+        zinfo.file_size = 0
+        zw.write_raw(zinfo.FileHeader())
+
+    def write(self, data):
+        if isinstance(data, unicode):
+            data = data.encode('utf-8')
+        self.zinfo.CRC = zlib.crc32(data, self.zinfo.CRC) & 0xffffffff
+        self.zinfo.file_size += len(data)
+        if self.co is not None:
+            data = self.co.compress(data)
+        self.zinfo.compress_size += len(data)
+        self.zw.write_raw(data)
+
+    # write compressed, the next part of the member's content (data)
+    # compressed elsewhere - for a deflated member, a block that
+    # carries on the deflate stream, so ended with Z_FULL_FLUSH, or
+    # Z_FINISH if it's the last.
+    def write_compressed(self, compressed, data):
+        if self.co is not None:
+            raise Exception('member is being compressed as it\'s written')
+        self.zinfo.CRC = zlib.crc32(data, self.zinfo.CRC) & 0xffffffff
+        self.zinfo.file_size += len(data)
+        self.zinfo.compress_size += len(compressed)
+        self.zw.write_raw(compressed)
+
+    def close(self):
+        if self.zw is None:
+            return
+        if self.co is not None:
+            data = self.co.flush()
+            self.zinfo.compress_size += len(data)
+            self.zw.write_raw(data)
+        self.zw.write_raw(struct.pack('<4sLLL', 'PK\x07\x08',
+                                      self.zinfo.CRC,
+                                      self.zinfo.compress_size,
+                                      self.zinfo.file_size))
+        self.zw.infos.append(self.zinfo)
+        self.zw.open_member = None
+        self.zw = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
+        return False
+
+def central_dir_entry(zinfo):
+    dt = zinfo.date_time
+    dosdate = (dt[0] - 1980) << 9 | dt[1] << 5 | dt[2]
+    dostime = dt[3] << 11 | dt[4] << 5 | (dt[5] // 2)
+    filename, flag_bits = zinfo._encodeFilenameFlags()
+    if (zinfo.compress_size > 0xffffffff or zinfo.file_size > 0xffffffff
+        or zinfo.header_offset > 0xffffffff):
+        raise Exception('zip member too big - zip64 not supported')
+    centdir = struct.pack(zipfile.structCentralDir,
+                          zipfile.stringCentralDir,
+                          zinfo.create_version, zinfo.create_system,
+                          zinfo.extract_version, zinfo.reserved,
+                          flag_bits, zinfo.compress_type, dostime, dosdate,
+                          zinfo.CRC, zinfo.compress_size, zinfo.file_size,
+                          len(filename), len(zinfo.extra),
+                          len(zinfo.comment), 0,
+                          zinfo.internal_attr, zinfo.external_attr,
+                          zinfo.header_offset)
+    return centdir + filename + zinfo.extra + zinfo.comment
+
+if __name__ == '__main__':
+    sys.stderr.write('I\'m a module.  Don\'t run me directly!')
+    sys.exit(-1)